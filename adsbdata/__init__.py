@@ -0,0 +1,3 @@
+'''
+Track formats, indexes and statistics shared by the web app and the data preparation scripts
+'''
@@ -0,0 +1,211 @@
+from datetime import datetime
+from math import cos, floor, radians, sqrt
+import os
+import sqlite3
+
+'''
+Spatial-temporal index of all tracks, sqlite database archive.sqlite next to the track files
+
+tracks     one row per indexed track file (json name), indexed by address and by callsign for aircraft histories
+cells      grid cell (CELL_DEG x CELL_DEG) x hour visited by a track, with the lowest height seen there
+Queries return the tracks with a position in a grid cell touching the search circle during the
+searched time, so they are exact to the cell size (about 1 km) and the hour.
+'''
+
+ARCHIVEINDEX = 'archive.sqlite'
+CELL_DEG = 0.01
+LON_CELLS = round(360 / CELL_DEG)
+KM_PER_DEG = 111.195
+MAX_RADIUS = 100.0  # (km)
+MAX_RESULTS = 1000
+QUERY_CELLS = 500   # cells per query
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    filename TEXT UNIQUE NOT NULL,
+    date TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    target_adr TEXT,
+    target_id TEXT
+);
+CREATE TABLE IF NOT EXISTS cells (
+    cell INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    track INTEGER NOT NULL,
+    min_height REAL,
+    PRIMARY KEY (cell, hour, track)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cells_track ON cells (track);
+CREATE INDEX IF NOT EXISTS tracks_adr ON tracks (target_adr, start);
+CREATE INDEX IF NOT EXISTS tracks_id ON tracks (target_id, start);
+'''
+
+
+def connect(dirname, readonly=False):
+    """
+    Open archive index of dirname, created if missing unless readonly
+    """
+    filename = os.path.join(dirname, ARCHIVEINDEX)
+    if readonly:
+        return sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+
+    conn = sqlite3.connect(filename)
+    # rollback journal, not WAL: read only connections of a WAL database create -wal and -shm files,
+    # which fails in a read only directory. Readers wait only while a batch of tracks is committed.
+    # Databases written in WAL mode before are switched back.
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def index_mtime(dirname):
+    """
+    Return mtime (ns) of archive index, None if there is none
+    Committed changes are always in the database file itself.
+    """
+    try:
+        return os.stat(os.path.join(dirname, ARCHIVEINDEX)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def cell_of(lat, lon):
+    return floor((lat + 90.0) / CELL_DEG) * LON_CELLS + floor((lon + 180.0) / CELL_DEG)
+
+
+def position_times(track: dict):
+    """
+    Yield (time stamp, position) of track positions
+    time_trans is seconds since midnight, positions without it get the time of the previous one
+    """
+    start = track['start']
+    midnight = start - start % 86400
+    stamp = start
+    for pos in track['positions']:
+        if 'time_trans' in pos:
+            t = midnight + pos['time_trans']
+            if t < stamp - 43200:   # past midnight
+                midnight += 86400
+                t += 86400
+            stamp = t
+        yield stamp, pos
+
+
+def track_cells(track: dict):
+    """
+    Return {(cell, hour): min height (ft) or None} of track
+    """
+    cells = {}
+    for stamp, pos in position_times(track):
+        if 'lat' not in pos or 'lon' not in pos:
+            continue
+        if 'geom_height' in pos:
+            height = pos['geom_height']
+        elif 'flight_lvl' in pos:
+            height = pos['flight_lvl'] * 100.0
+        else:
+            height = None
+
+        key = (cell_of(pos['lat'], pos['lon']), int(stamp // 3600))
+        known = cells.get(key)
+        if key not in cells or (height is not None and (known is None or height < known)):
+            cells[key] = height
+
+    return cells
+
+
+def remove_track(conn, filename):
+    """Remove track file from index"""
+    row = conn.execute('SELECT id FROM tracks WHERE filename = ?', (filename,)).fetchone()
+    if row is not None:
+        conn.execute('DELETE FROM cells WHERE track = ?', row)
+        conn.execute('DELETE FROM tracks WHERE id = ?', row)
+
+
+def add_track(conn, filename, track: dict):
+    """
+    Add track (dict as written by tracker) under its json filename, replacing an existing entry
+    """
+    remove_track(conn, filename)
+    date = datetime.utcfromtimestamp(track['start']).strftime('%Y-%m-%d')
+    cur = conn.execute('INSERT INTO tracks (filename, date, start, end, target_adr, target_id) VALUES (?, ?, ?, ?, ?, ?)',
+        (filename, date, track['start'], track['end'], track['report'].get('target_adr'), (track.get('target_id') or '').strip() or None))
+    track_id = cur.lastrowid
+    conn.executemany('INSERT INTO cells (cell, hour, track, min_height) VALUES (?, ?, ?, ?)',
+        ((cell, hour, track_id, height) for (cell, hour), height in track_cells(track).items()))
+
+
+def aircraft_history(conn, key, limit=MAX_RESULTS):
+    """
+    Tracks of aircraft by icao address (hex) or callsign, newest first
+    Return list of dicts (filename, date, start, end, target_adr, target_id)
+    """
+    rows = conn.execute('SELECT filename, date, start, end, target_adr, target_id FROM tracks WHERE target_adr = ? '
+        'UNION SELECT filename, date, start, end, target_adr, target_id FROM tracks WHERE target_id = ? '
+        'ORDER BY start DESC, filename LIMIT ?', (key.lower(), key.upper().strip(), limit))
+    return [{'filename': filename, 'date': date, 'start': start, 'end': end, 'target_adr': target_adr, 'target_id': target_id}
+        for filename, date, start, end, target_adr, target_id in rows]
+
+
+def clear(conn):
+    conn.execute('DELETE FROM cells')
+    conn.execute('DELETE FROM tracks')
+
+
+def cells_in_circle(lat, lon, radius):
+    """
+    Return ids of grid cells touching circle around lat, lon with radius (km)
+    """
+    cells = []
+    dlat = radius / KM_PER_DEG
+    for row in range(floor((lat - dlat + 90.0) / CELL_DEG), floor((lat + dlat + 90.0) / CELL_DEG) + 1):
+        south = row * CELL_DEG - 90.0
+        north = south + CELL_DEG
+        nearest = min(max(lat, south), north)   # latitude of row nearest to center
+        dy = (nearest - lat) * KM_PER_DEG
+        if dy*dy > radius*radius:
+            continue
+        dlon = sqrt(radius*radius - dy*dy) / (KM_PER_DEG * max(cos(radians(nearest)), 1e-6))
+        first = floor((lon - dlon + 180.0) / CELL_DEG)
+        last = floor((lon + dlon + 180.0) / CELL_DEG)
+        cells.extend(range(row * LON_CELLS + max(first, 0), row * LON_CELLS + min(last, LON_CELLS - 1) + 1))
+
+    return cells
+
+
+def search(conn, lat, lon, radius, start, end, max_height=None, limit=MAX_RESULTS):
+    """
+    Tracks passing within radius (km) of lat, lon between time stamps start and end,
+    below max_height (ft) there if given.
+    Return list of dicts (filename, date, start, end, target_adr, target_id, min_height) sorted by start
+    """
+    radius = min(radius, MAX_RADIUS)
+    first_hour, last_hour = int(start // 3600), int(end // 3600)
+    heights = {}    # track id -> lowest height in area
+    cells = cells_in_circle(lat, lon, radius)
+    for i in range(0, len(cells), QUERY_CELLS):
+        chunk = cells[i:i + QUERY_CELLS]
+        # one primary key range per cell: (cell, first_hour) .. (cell, last_hour)
+        rows = conn.execute('WITH area(cell) AS (VALUES {}) SELECT track, MIN(min_height) FROM area JOIN cells USING (cell) '
+            'WHERE hour BETWEEN ? AND ? GROUP BY track'.format(','.join(['(?)'] * len(chunk))), chunk + [first_hour, last_hour])
+        for track_id, height in rows:
+            if track_id not in heights or (height is not None and (heights[track_id] is None or height < heights[track_id])):
+                heights[track_id] = height
+
+    if max_height is not None:
+        heights = {track_id: height for track_id, height in heights.items() if height is not None and height <= max_height}
+
+    results = []
+    ids = list(heights)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows = conn.execute('SELECT id, filename, date, start, end, target_adr, target_id FROM tracks WHERE id IN ({})'.format(','.join('?' * len(chunk))), chunk)
+        for track_id, filename, date, t_start, t_end, target_adr, target_id in rows:
+            if t_start <= end and t_end >= start:
+                results.append({'filename': filename, 'date': date, 'start': t_start, 'end': t_end,
+                    'target_adr': target_adr, 'target_id': target_id, 'min_height': heights[track_id]})
+
+    results.sort(key=lambda result: (result['start'], result['filename']))
+    return results[:limit]
@@ -0,0 +1,78 @@
+import json
+import mmap
+import os
+import struct
+from .util import write_atomic
+
+'''
+Day bundle: all track files of a date in one file <date>.bundle
+
+header     magic b'DAY1', length of table
+table      utf-8 json {track filename: [offset, length, format]}, format 'json' or 'trk'
+data       track files as stored (json text or gzip compressed binary), offsets relative to file start
+'''
+
+MAGIC = b'DAY1'
+HEADER = struct.Struct('<4sI')
+EXT = '.bundle'
+
+
+def bundle_filename(date: str) -> str:
+    return date + EXT
+
+
+class DayBundle:
+    """
+    Memory mapped day bundle
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            self.mtime = os.fstat(file.fileno()).st_mtime_ns
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, table_len = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('Not a day bundle')
+        self.table = json.loads(self._map[HEADER.size:HEADER.size + table_len].decode('utf-8'))
+
+    def __contains__(self, filename):
+        return filename in self.table
+
+    def get(self, filename):
+        """
+        Return (data, format) of bundled track file, None if not in bundle
+        """
+        entry = self.table.get(filename)
+        if entry is None:
+            return None
+        ofs, length, fmt = entry
+        return self._map[ofs:ofs + length], fmt
+
+
+def write(filename, tracks):
+    """
+    Write day bundle from iterable of (track filename, data, format)
+    """
+    tracks = list(tracks)
+    table = {}
+    ofs = 0
+    for name, data, fmt in tracks:
+        table[name] = [ofs, len(data), fmt]
+        ofs += len(data)
+
+    # offsets depend on table length, which depends on offsets: grow until stable
+    base = 0
+    while True:
+        table_bytes = json.dumps({name: [base + o, l, f] for name, (o, l, f) in table.items()}).encode('utf-8')
+        if HEADER.size + len(table_bytes) <= base:
+            break
+        base = HEADER.size + len(table_bytes)
+    table_bytes = table_bytes.ljust(base - HEADER.size)
+
+    def write_bundle(file):
+        file.write(HEADER.pack(MAGIC, len(table_bytes)))
+        file.write(table_bytes)
+        for _, data, _ in tracks:
+            file.write(data)
+
+    write_atomic(filename, write_bundle, binary=True)
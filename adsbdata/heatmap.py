@@ -0,0 +1,280 @@
+from calendar import monthrange
+from functools import lru_cache
+from math import log1p, pi
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from .util import write_atomic
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+'''
+Density heatmap of track positions as XYZ png tiles
+
+Per day, the web mercator pixels at BASE_ZOOM crossed by the tracks are counted and stored sparse
+as heat/<date>.npz (keys y << 32 | x sorted, delta encoded, and counts). Days losing all tracks keep an
+empty file, so the latest mtime of a range only ever grows. Tiles of a date range at zoom <= BASE_ZOOM
+sum the pixels of the days in range. Tiles of single days, months and years are cached as
+heat/tiles/<from>_<to>/<version>/<z>/<x>/<y>.png, least recently used ones are removed
+beyond TILE_CACHE_BYTES. Tiles of other ranges are rendered for each request.
+'''
+
+HEATDIR = 'heat'
+BASE_ZOOM = 13  # about 10 m pixels
+TILESIZE = 256
+MAX_GAP_PX = 512    # (base pixels) longer gaps between positions are not connected
+SATURATION = 4.0    # count per base pixel and day shown in full colour at BASE_ZOOM
+DAY_CACHE_SIZE = 64  # days of bins kept loaded
+DAY_COMPRESSLEVEL = 1    # zlib level of day files, rewritten by every incremental index update
+TILE_CACHE_BYTES = int(os.environ.get('HEAT_CACHE_BYTES', 512 * 1024 * 1024))  # size limit of tile cache
+TILE_CACHE_KEEP = 0.8    # share of TILE_CACHE_BYTES left by eviction
+
+
+def mercator_px(lat, lon, zoom=BASE_ZOOM):
+    """Web mercator pixel coordinates (float arrays) of lat, lon arrays at zoom"""
+    scale = TILESIZE * 2**zoom
+    x = (np.asarray(lon) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(np.radians(lat)) + 1.0 / np.cos(np.radians(lat))) / pi) / 2.0 * scale
+    return x, y
+
+
+def track_pixels(track: dict):
+    """
+    Return keys of base pixels along track, positions connected by straight lines
+    """
+    located = [pos for pos in track['positions'] if 'lat' in pos and 'lon' in pos]
+    if not located:
+        return np.zeros(0, dtype=np.uint64)
+
+    x, y = mercator_px([pos['lat'] for pos in located], [pos['lon'] for pos in located])
+    dx, dy = np.diff(x), np.diff(y)
+    steps = np.ceil(np.maximum(np.abs(dx), np.abs(dy))).astype(np.int64)
+    steps[(steps < 1) | (steps > MAX_GAP_PX)] = 1    # gaps: start point only
+    idx = np.repeat(np.arange(len(steps)), steps)
+    t = (np.arange(len(idx)) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[idx]
+    px = np.append(x[:-1][idx] + dx[idx] * t, x[-1]).astype(np.uint64)
+    py = np.append(y[:-1][idx] + dy[idx] * t, y[-1]).astype(np.uint64)
+    return np.unique(py << np.uint64(32) | px)   # a track counts once per pixel
+
+
+def day_bins(tracks):
+    """
+    Return (keys, counts) of base pixels of track dicts, keys sorted
+    """
+    pixels = [track_pixels(track) for track in tracks]
+    if not pixels:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32)
+    keys, counts = np.unique(np.concatenate(pixels), return_counts=True)
+    return keys, np.minimum(counts, 0xffff).astype(np.uint32)
+
+
+def add_pixels(bins, pixels):
+    """
+    Return (keys, counts) of bins (None for no bins) with the keys of track_pixels() of more tracks added
+    """
+    if bins is None:
+        bins = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32)
+    keys, inverse = np.unique(np.concatenate([bins[0]] + pixels), return_inverse=True)
+    weights = np.concatenate([bins[1]] + [np.ones(len(p), dtype=np.uint32) for p in pixels])
+    counts = np.bincount(inverse, weights=weights, minlength=len(keys))
+    return keys, np.minimum(counts, 0xffff).astype(np.uint32)
+
+
+def day_filename(dirname, date):
+    return os.path.join(dirname, HEATDIR, date + '.npz')
+
+
+def save_day(dirname, date, bins):
+    """Write day bins atomically, as np.savez_compressed() does but with DAY_COMPRESSLEVEL"""
+    filename = day_filename(dirname, date)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    arrays = (('dkeys', np.diff(bins[0], prepend=np.uint64(0))), ('counts', bins[1].astype(np.uint16)))
+
+    def write(file):
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED, compresslevel=DAY_COMPRESSLEVEL) as npz:
+            for name, array in arrays:
+                with npz.open(name + '.npy', 'w') as member:
+                    np.lib.format.write_array(member, array)
+
+    write_atomic(filename, write, binary=True)
+
+
+def remove_day(dirname, date):
+    """Store empty bins of a day without tracks, if it had bins before"""
+    if os.path.exists(day_filename(dirname, date)):
+        save_day(dirname, date, (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32)))
+
+
+def load_day(dirname, date):
+    """Return (keys, counts) of day, None if there are none"""
+    try:
+        with np.load(day_filename(dirname, date)) as data:
+            return np.cumsum(data['dkeys'], dtype=np.uint64), data['counts'].astype(np.uint32)
+    except FileNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=DAY_CACHE_SIZE)
+def _load_day_cached(dirname, date, mtime):
+    return load_day(dirname, date)
+
+
+def tile_counts(days, z, x, y):
+    """
+    Sum (keys, counts) of days into TILESIZE x TILESIZE array of tile z/x/y
+    """
+    shift = BASE_ZOOM - z
+    size = TILESIZE << shift    # tile size in base pixels
+    x0, y0 = x * size, y * size
+    grid = np.zeros(TILESIZE * TILESIZE, dtype=np.uint32)
+    for keys, counts in days:
+        lo, hi = np.searchsorted(keys, np.array([y0 << 32, (y0 + size) << 32], dtype=np.uint64))    # rows of tile
+        keys, counts = keys[lo:hi], counts[lo:hi]
+        px = (keys & np.uint64(0xffffffff)).astype(np.int64) - x0
+        inside = (px >= 0) & (px < size)
+        py = (keys[inside] >> np.uint64(32)).astype(np.int64) - y0
+        grid += np.bincount((py >> shift) * TILESIZE + (px[inside] >> shift), weights=counts[inside], minlength=TILESIZE * TILESIZE).astype(np.uint32)
+
+    return grid.reshape(TILESIZE, TILESIZE)
+
+
+def colormap():
+    """256 RGBA colours from transparent blue over yellow to red"""
+    stops = np.array([[0.0, 0, 0, 255, 0], [0.2, 0, 128, 255, 140], [0.5, 255, 255, 0, 200], [1.0, 255, 0, 0, 240]])
+    v = np.linspace(0.0, 1.0, 256)
+    return np.stack([np.interp(v, stops[:, 0], stops[:, i]) for i in range(1, 5)], axis=1).astype(np.uint8)
+
+
+def render_png(grid, num_days, z):
+    """
+    Render tile counts as RGBA png, log scale saturating at SATURATION per day (lines get 2x per zoom level less)
+    """
+    saturation = SATURATION * max(num_days, 1) * 2**(BASE_ZOOM - z)
+    level = np.clip(np.log1p(grid) / log1p(saturation), 0.0, 1.0)
+    rgba = colormap()[(level * 255).astype(np.uint8)]
+    rgba[grid == 0] = 0
+
+    raw = np.concatenate([np.zeros((TILESIZE, 1), dtype=np.uint8), rgba.reshape(TILESIZE, -1)], axis=1)  # filter type 0 per row
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', TILESIZE, TILESIZE, 8, 6, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+def day_mtimes(dirname):
+    """Return {date: mtime (ns)} of stored days"""
+    mtimes = {}
+    try:
+        with os.scandir(os.path.join(dirname, HEATDIR)) as it:
+            for entry in it:
+                if entry.name.endswith('.npz'):
+                    mtimes[entry.name[:-len('.npz')]] = entry.stat().st_mtime_ns
+    except FileNotFoundError:
+        pass
+    return mtimes
+
+
+def range_version(dates, mtimes):
+    """Version of days of dates: '<latest mtime>-<number of stored days>', grows with every change"""
+    stored = [mtimes[date] for date in dates if date in mtimes]
+    return '{}-{}'.format(max(stored, default=0), len(stored))
+
+
+def cached_range(first, last):
+    """True if tiles of date range first to last (YYYY-MM-DD) are cached: a single day, a month or a year"""
+    if first == last:
+        return True
+    year, month = int(first[:4]), int(first[5:7])
+    if first[8:] == '01' and last == '{}-{:02}-{:02}'.format(year, month, monthrange(year, month)[1]):
+        return True
+    return first[5:] == '01-01' and last == first[:4] + '-12-31'
+
+
+class TileCache:
+    """
+    Png tiles on disk, limited to max_bytes, the least recently used tiles are removed first
+    The size is counted per process from a scan of the cache directory, other processes writing meanwhile
+    are seen by the next scan.
+    """
+    def __init__(self, dirname, max_bytes=TILE_CACHE_BYTES):
+        self.root = os.path.join(dirname, HEATDIR, 'tiles')
+        self.max_bytes = max_bytes
+        self.size = None    # unknown until scanned
+        self._lock = threading.Lock()
+
+    def filename(self, first, last, version, z, x, y):
+        return os.path.join(self.root, '{}_{}'.format(first, last), version, str(z), str(x), '{}.png'.format(y))
+
+    def get(self, filename):
+        """Return png of tile file, None if not cached"""
+        try:
+            with open(filename, 'rb') as file:
+                png = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(filename)  # mtime is the time of last use
+        except FileNotFoundError:
+            pass
+        return png
+
+    def put(self, filename, png):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        write_atomic(filename, lambda file: file.write(png), binary=True)   # concurrent requests of a tile may write it twice
+        with self._lock:
+            if self.size is not None:
+                self.size += len(png)
+            if self.size is None or self.size > self.max_bytes:
+                self.evict()
+
+    def tiles(self):
+        """Yield (mtime, size, filename) of cached tiles"""
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime_ns, st.st_size, filename
+
+    def evict(self):
+        """Scan cache, remove least recently used tiles while larger than max_bytes, down to TILE_CACHE_KEEP of it"""
+        tiles = sorted(self.tiles())
+        self.size = sum(size for _, size, _ in tiles)
+        if self.size <= self.max_bytes:
+            return
+        for _, size, filename in tiles:
+            if self.size <= self.max_bytes * TILE_CACHE_KEEP:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+def get_tile(dirname, dates, mtimes, z, x, y, cache=None):
+    """
+    Return png of tile z/x/y for sorted dates with days' mtimes, from TileCache cache if given
+    """
+    if cache is not None:
+        filename = cache.filename(dates[0], dates[-1], range_version(dates, mtimes), z, x, y)
+        png = cache.get(filename)
+        if png is not None:
+            return png
+
+    days = [_load_day_cached(dirname, date, mtimes[date]) for date in dates if date in mtimes]
+    days = [day for day in days if day is not None and len(day[0]) > 0]
+    png = render_png(tile_counts(days, z, x, y), len(days), z)
+
+    if cache is not None:
+        cache.put(filename, png)
+    return png
@@ -0,0 +1,381 @@
+from collections import deque
+from itertools import islice
+from threading import Condition, Thread
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import asyncio
+import json
+import socket
+import time
+from .util import parse_address
+
+'''
+Live positions of active tracks, from the tracker to the web app over local UDP
+
+The tracker sends compact json deltas at most every PUBLISH_INTERVAL seconds:
+{"t": time stamp, "u": [[adr, lat, lon, height ft or null, callsign or null], ...], "r": [removed adr, ...]}
+Every SNAPSHOT_INTERVAL seconds a delta carries the rows of all active tracks, split into parts
+marked "s": [part, number of parts], so receivers resync after lost datagrams: tracks in none of
+the parts are removed. Tracks not updated for TRACK_TTL seconds are removed by the receiver,
+also when the tracker stopped.
+A receiver keeps a ring buffer of sequence numbered messages plus the current state of all tracks,
+which every client reads from.
+
+Serve /api/live with the live server, python3 -m adsbdata.livestream, and route it there from the
+reverse proxy in front of the web app (or point LIVE_URL of the web app to it). It serves any number
+of clients from one asyncio loop. The web app's own /api/live holds a server thread per client,
+it is meant for development and limited to LIVE_MAX_CLIENTS.
+'''
+
+LIVE_ADDRESS = ('127.0.0.1', 30021)
+PUBLISH_INTERVAL = 1.0  # (s)
+SNAPSHOT_INTERVAL = 10.0    # (s) between deltas with all active tracks
+TRACK_TTL = 3 * SNAPSHOT_INTERVAL  # (s) without update after which a track is removed
+MAX_DATAGRAM = 60000    # bytes, larger deltas are split
+RING_SIZE = 256     # messages kept for clients catching up
+RECV_SIZE = 65536
+LIVE_PATH = '/api/live'
+CLIENT_MIN_INTERVAL = 1.0     # (s) between events to a client
+CLIENT_MAX_INTERVAL = 60.0
+KEEPALIVE = 15.0    # (s) without events after which a comment is sent
+
+
+def track_row(adr, rec):
+    """Update row of track from its latest record"""
+    if 'geom_height' in rec:
+        height = rec['geom_height']
+    elif 'flight_lvl' in rec:
+        height = rec['flight_lvl'] * 100.0
+    else:
+        height = None
+    target_id = rec.get('target_id')
+    return [adr, rec['pos_wgs84']['lat'], rec['pos_wgs84']['lon'], height, target_id.strip() if target_id else None]
+
+
+def encode(msg):
+    return json.dumps(msg, separators=(',', ':')).encode('utf-8')
+
+
+def split_message(msg):
+    """
+    Split delta msg by its rows into parts of at most MAX_DATAGRAM bytes, removals in the first part only
+    """
+    parts, pending = [], [msg]
+    while pending:
+        msg = pending.pop()
+        if len(encode(msg)) > MAX_DATAGRAM and len(msg['u']) > 1:
+            half = len(msg['u']) // 2
+            pending += [{'t': msg['t'], 'u': msg['u'][half:], 'r': []}, dict(msg, u=msg['u'][:half])]
+            continue
+        parts.append(msg)
+    return parts
+
+
+class Publisher:
+    """
+    Collects changed and removed tracks, sends them as one delta per PUBLISH_INTERVAL (of record time)
+    """
+    def __init__(self, address=LIVE_ADDRESS):
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.active = {}    # adr -> row of all active tracks
+        self.updated = {}   # adr -> row
+        self.removed = set()
+        self.next_publish = 0.0
+        self.next_snapshot = 0.0
+
+    def update(self, adr, rec):
+        self.active[adr] = self.updated[adr] = track_row(adr, rec)
+        self.removed.discard(adr)
+
+    def remove(self, adr):
+        self.active.pop(adr, None)
+        self.updated.pop(adr, None)
+        self.removed.add(adr)
+
+    def flush(self, stamp, force=False):
+        """
+        Send collected changes if PUBLISH_INTERVAL has passed since the last delta,
+        all active tracks if SNAPSHOT_INTERVAL has passed since the last snapshot
+        """
+        if not force and stamp < self.next_publish:
+            return
+        self.next_publish = stamp + PUBLISH_INTERVAL
+        snapshot = stamp >= self.next_snapshot
+        if snapshot:
+            self.next_snapshot = stamp + SNAPSHOT_INTERVAL
+            self.updated = dict(self.active)
+        elif not (self.updated or self.removed):
+            return
+
+        rows, removed = list(self.updated.values()), sorted(self.removed)
+        self.updated, self.removed = {}, set()
+        parts = split_message({'t': stamp, 'u': rows, 'r': removed})
+        for i, msg in enumerate(parts):
+            if snapshot:
+                msg['s'] = [i, len(parts)]  # a few bytes, parts stay well below the UDP limit
+            try:
+                self.sock.sendto(encode(msg), self.address)
+            except OSError:
+                pass    # nobody listening, live view is best effort
+
+
+class LiveFeed:
+    """
+    Receives deltas of the tracker into a ring buffer, shared by all clients.
+    Clients ask for everything after the sequence number they have seen. Changes are merged,
+    so a client fetching seldom gets one combined delta; a client whose sequence number fell
+    out of the ring gets the full state instead.
+    Tracks missing from all parts of a snapshot delta or not updated for ttl seconds are removed.
+    """
+    def __init__(self, address=LIVE_ADDRESS, size=RING_SIZE, ttl=TRACK_TTL):
+        self.address = address
+        self.ring = deque(maxlen=size)  # (seq, msg)
+        self.seq = 0
+        self.stamp = None
+        self.state = {}     # adr -> row of active tracks
+        self.seen = {}  # adr -> monotonic time of last update
+        self.ttl = ttl
+        self.cond = Condition()
+        self._thread = None
+        self._snapshot = None   # (stamp, parts received, tracks) of the snapshot delta being received
+
+    def start(self):
+        """Start receiver thread once, OSError if the address can't be bound"""
+        with self.cond:
+            if self._thread is not None:
+                return
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(self.address)
+            sock.settimeout(PUBLISH_INTERVAL)
+            self._thread = Thread(target=self._receive, args=(sock,), daemon=True)
+            self._thread.start()
+
+    def _receive(self, sock):
+        while True:
+            try:
+                data = sock.recv(RECV_SIZE)
+            except socket.timeout:
+                self.expire()
+                continue
+            self.receive(data)
+            self.expire()
+
+    def receive(self, data):
+        """Publish datagram data, ignored if it isn't json"""
+        try:
+            msg = json.loads(data)
+        except ValueError:
+            return
+        self.publish(msg)
+
+    def publish(self, msg):
+        """
+        Add delta msg to ring and state, wake up waiting clients
+        With the last part of a snapshot delta, tracks in none of its parts are added to its removals.
+        """
+        now = time.monotonic()
+        with self.cond:
+            if 's' in msg:
+                msg = self._snapshot_part(msg)
+            for row in msg.get('u', []):
+                self.state[row[0]] = row
+                self.seen[row[0]] = now
+            for adr in msg.get('r', []):
+                self.state.pop(adr, None)
+                self.seen.pop(adr, None)
+            self._append(msg)
+
+    def _snapshot_part(self, msg):
+        msg = dict(msg)
+        part, parts = msg.pop('s')
+        if part == 0:
+            self._snapshot = (msg.get('t'), set(), set())
+        if self._snapshot is None or self._snapshot[0] != msg.get('t'):
+            return msg  # first part lost
+        _, received, tracks = self._snapshot
+        received.add(part)
+        tracks.update(row[0] for row in msg.get('u', []))
+        if len(received) == parts:
+            self._snapshot = None
+            msg['r'] = sorted(set(msg.get('r', [])) | (self.state.keys() - tracks))
+        return msg
+
+    def expire(self):
+        """Remove tracks not updated for ttl seconds"""
+        limit = time.monotonic() - self.ttl
+        with self.cond:
+            expired = sorted(adr for adr, seen in self.seen.items() if seen < limit)
+            if expired:
+                self.publish({'t': self.stamp, 'u': [], 'r': expired})
+
+    def _append(self, msg):
+        self.seq += 1
+        self.stamp = msg.get('t')
+        self.ring.append((self.seq, msg))
+        self.cond.notify_all()
+
+    def snapshot(self):
+        """Return (seq, full state message)"""
+        with self.cond:
+            return self.seq, {'t': self.stamp, 'u': list(self.state.values()), 'r': [], 'full': True}
+
+    def changes(self, after, timeout):
+        """
+        Wait up to timeout for messages after seq, return (seq, merged delta message), delta None if there is nothing new.
+        Returns the full state if after is no longer in the ring.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > after, timeout)
+            if self.seq <= after:
+                return after, None
+            if not self.ring or self.ring[0][0] > after + 1:
+                return self.seq, {'t': self.stamp, 'u': list(self.state.values()), 'r': [], 'full': True}
+            pending = list(islice(self.ring, after + 1 - self.ring[0][0], None))
+
+        updated, removed = {}, set()
+        for _, msg in pending:
+            for row in msg.get('u', []):
+                updated[row[0]] = row
+                removed.discard(row[0])
+            for adr in msg.get('r', []):
+                updated.pop(adr, None)
+                removed.add(adr)
+        return pending[-1][0], {'t': pending[-1][1].get('t'), 'u': list(updated.values()), 'r': sorted(removed)}
+
+
+def client_interval(interval):
+    """Interval (s) between events asked for by a client, limited to CLIENT_MIN_INTERVAL..CLIENT_MAX_INTERVAL"""
+    return min(max(interval, CLIENT_MIN_INTERVAL), CLIENT_MAX_INTERVAL)
+
+
+def sse_event(seq, msg):
+    kind = 'snapshot' if msg.get('full') else 'delta'
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(seq, kind, json.dumps(msg, separators=(',', ':')))
+
+
+def sse_events(feed, last_seq, interval, keepalive=KEEPALIVE):
+    """
+    Yield server sent events of feed for one client, at most one per interval seconds
+    Starts with the full state unless last_seq (Last-Event-ID) is still in the ring.
+    Blocks the calling thread for the life of the client.
+    """
+    if last_seq is None or last_seq > feed.seq:
+        last_seq, msg = feed.snapshot()
+        yield sse_event(last_seq, msg)
+
+    while True:
+        next_event = time.monotonic() + interval
+        last_seq, msg = feed.changes(last_seq, keepalive)
+        if msg is None:
+            yield ': keepalive\n\n'
+            continue
+
+        yield sse_event(last_seq, msg)
+        time.sleep(max(0.0, next_event - time.monotonic()))    # rate limit, changes meanwhile are merged
+
+
+class LiveServer(asyncio.DatagramProtocol):
+    """
+    Serves LIVE_PATH of feed to any number of clients from one asyncio loop, no thread per client.
+    The deltas of the tracker are received by the same loop.
+    """
+    def __init__(self, feed, keepalive=KEEPALIVE):
+        self.feed = feed
+        self.keepalive = keepalive
+        self.changed = None     # asyncio.Event, set and replaced with each new message of feed
+
+    def datagram_received(self, data, addr):
+        self.feed.receive(data)
+        self._notify()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def run(self, http_address):
+        loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=self.feed.address)
+        server = await asyncio.start_server(self.client, *http_address)
+        try:
+            while True:
+                await asyncio.sleep(PUBLISH_INTERVAL)
+                seq = self.feed.seq
+                self.feed.expire()
+                if self.feed.seq != seq:
+                    self._notify()
+        finally:
+            server.close()
+            transport.close()
+
+    async def events(self, last_seq, interval):
+        """Async version of sse_events()"""
+        feed, loop = self.feed, asyncio.get_running_loop()
+        if last_seq is None or last_seq > feed.seq:
+            last_seq, msg = feed.snapshot()
+            yield sse_event(last_seq, msg)
+
+        while True:
+            next_event = loop.time() + interval
+            if feed.seq <= last_seq:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+
+            last_seq, msg = feed.changes(last_seq, 0)   # doesn't block, the loop is the only thread
+            yield sse_event(last_seq, msg)
+            await asyncio.sleep(max(0.0, next_event - loop.time()))
+
+    async def client(self, reader, writer):
+        """One http client, GET LIVE_PATH[?interval=s] is answered with server sent events"""
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            url = urlsplit(request[1]) if len(request) == 3 else None
+            if url is None or request[0] != 'GET' or url.path != LIVE_PATH:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+                return
+
+            interval = _number(parse_qs(url.query).get('interval', [None])[0], float, CLIENT_MIN_INTERVAL)
+            last_seq = _number(headers.get('last-event-id'), int, None)
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/event-stream\r\n'
+                         b'Cache-Control: no-cache\r\n'
+                         b'X-Accel-Buffering: no\r\n'
+                         b'Access-Control-Allow-Origin: *\r\n'
+                         b'Connection: close\r\n\r\n')
+            async for event in self.events(last_seq, client_interval(interval)):
+                writer.write(event.encode('utf-8'))
+                await writer.drain()    # a slow client only holds up itself
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _number(s, type, default):
+    try:
+        return type(s)
+    except (TypeError, ValueError):
+        return default
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve live positions of tracker.py --live as server sent events.')
+    parser.add_argument('--udp', dest='udp', help='Receive deltas of the tracker at UDP [host:]port', default='{}:{}'.format(*LIVE_ADDRESS))
+    parser.add_argument('--http', dest='http', help='Serve {} at [host:]port'.format(LIVE_PATH), default='127.0.0.1:8021')
+
+    args = parser.parse_args()
+    server = LiveServer(LiveFeed(parse_address(args.udp, '127.0.0.1')))
+    asyncio.run(server.run(parse_address(args.http, '127.0.0.1')))
@@ -0,0 +1,107 @@
+from math import cos, radians
+
+'''
+Levels of detail of track positions for map zoom levels
+
+A level keeps the indices of the positions left by Douglas-Peucker simplification
+with a tolerance of about one pixel at its zoom level.
+Levels are stored in the track dict as 'lod': {zoom: [indices]} (zoom as str, json keys)
+'''
+
+LOD_ZOOMS = (8, 10, 12, 14)    # above the highest level all positions are used
+EQUATOR_M_PER_PX = 156543.03    # (m) web mercator pixel size at zoom 0
+TOLERANCE_PX = 1.0
+EARTH_RADIUS = 6371000.0   # (m)
+
+
+def douglas_peucker(xy, tolerance):
+    """
+    Return sorted indices of points of polyline xy [(x, y)] kept with tolerance
+    """
+    n = len(xy)
+    if n < 3:
+        return list(range(n))
+
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    tol2 = tolerance * tolerance
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        x0, y0 = xy[first]
+        dx, dy = xy[last][0] - x0, xy[last][1] - y0
+        seg2 = dx*dx + dy*dy
+
+        max_d2, max_i = -1.0, first
+        for i in range(first + 1, last):
+            px, py = xy[i][0] - x0, xy[i][1] - y0
+            if seg2 > 0.0:
+                t = min(max((px*dx + py*dy) / seg2, 0.0), 1.0)
+                px, py = px - t*dx, py - t*dy
+            d2 = px*px + py*py
+            if d2 > max_d2:
+                max_d2, max_i = d2, i
+
+        if max_d2 > tol2:
+            keep[max_i] = True
+            if max_i - first > 1:
+                stack.append((first, max_i))
+            if last - max_i > 1:
+                stack.append((max_i, last))
+
+    return [i for i, k in enumerate(keep) if k]
+
+
+def lod_levels(positions):
+    """
+    Compute levels of detail of track positions
+    Positions without lat/lon are kept in all levels.
+    """
+    located = [i for i, pos in enumerate(positions) if 'lat' in pos and 'lon' in pos]
+    if not located:
+        return {}
+
+    lat0 = positions[located[0]]['lat']
+    kx = radians(1.0) * EARTH_RADIUS * cos(radians(lat0))
+    ky = radians(1.0) * EARTH_RADIUS
+    xy = [(positions[i]['lon'] * kx, positions[i]['lat'] * ky) for i in located]
+    unlocated = [i for i, pos in enumerate(positions) if not ('lat' in pos and 'lon' in pos)]
+
+    levels = {}
+    for zoom in LOD_ZOOMS:
+        tolerance = TOLERANCE_PX * EQUATOR_M_PER_PX * cos(radians(lat0)) / 2**zoom
+        indices = [located[i] for i in douglas_peucker(xy, tolerance)]
+        levels[str(zoom)] = sorted(indices + unlocated) if unlocated else indices
+
+    return levels
+
+
+def level_for_zoom(levels, zoom):
+    """
+    Return indices of the coarsest level detailed enough for map zoom, None for all positions
+    """
+    for level in LOD_ZOOMS:
+        if zoom <= level and str(level) in levels:
+            return levels[str(level)]
+
+    return None
+
+
+def apply_lod(track: dict, zoom=None) -> dict:
+    """
+    Remove 'lod' from track dict, with zoom reduce positions to the matching level
+    Levels are computed if the track has none stored.
+    """
+    levels = track.pop('lod', None)
+    if zoom is None:
+        return track
+
+    if levels is None:
+        levels = lod_levels(track['positions'])
+
+    indices = level_for_zoom(levels, zoom)
+    if indices is not None:
+        positions = track['positions']
+        track['positions'] = [positions[i] for i in indices]
+
+    return track
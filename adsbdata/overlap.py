@@ -0,0 +1,36 @@
+import heapq
+
+'''
+Overlap levels of time intervals (interval graph colouring)
+'''
+
+END, START, EMPTY_END = 0, 1, 2    # order of events at equal times
+
+
+def overlap_levels(intervals):
+    """
+    Assign each interval (start, length) the lowest level not used by an interval overlapping it.
+    An interval ending at the time another one starts does not overlap it.
+    Returns list of levels in order of intervals.
+    """
+    events = []
+    for i, (start, length) in enumerate(intervals):
+        events.append((start, START, i))
+        events.append((start + length, END if length > 0 else EMPTY_END, i))
+
+    events.sort()
+
+    levels = [-1] * len(intervals)
+    free = []   # heap of released levels below next_level
+    next_level = 0
+    for _, kind, i in events:
+        if kind == START:
+            if free:
+                levels[i] = heapq.heappop(free)
+            else:
+                levels[i] = next_level
+                next_level += 1
+        else:
+            heapq.heappush(free, levels[i])
+
+    return levels
@@ -0,0 +1,166 @@
+from array import array
+from itertools import accumulate, compress
+import gzip
+import json
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+'''
+Compact binary track format
+
+Track files are stored gzip compressed as <name>.trk.gz next to (or instead of) <name>.json,
+ready to be served with Content-Encoding: gzip.
+
+header     magic b'TRK1', number of positions, length of meta data
+meta       utf-8 json of all track fields but 'positions'
+flags      one byte per position, bit i set if FIELDS[i] is present
+columns    one int32 column per field in FIELDS, little endian,
+           fixed point values (value * factor) as deltas to the previous position
+'''
+
+MAGIC = b'TRK1'
+HEADER = struct.Struct('<4sII')
+EXT = '.trk.gz'
+FIELDS = (('lat', 1e5), ('lon', 1e5), ('time_trans', 128.0), ('geom_height', 0.16), ('flight_lvl', 4.0))
+
+# field names and compress() selectors for each flags value
+FLAG_FIELDS = [(tuple(name for i, (name, _) in enumerate(FIELDS) if f & (1 << i)), tuple(f & (1 << i) for i in range(len(FIELDS))))
+    for f in range(1 << len(FIELDS))]
+
+
+def encode(track: dict) -> bytes:
+    """
+    Encode track dict (as written by tracker) into compressed binary format
+    Raises ValueError if the track can't be represented exactly
+    """
+    positions = track['positions']
+    meta = json.dumps({k: v for k, v in track.items() if k != 'positions'}).encode('utf-8')
+    flags = bytearray(len(positions))
+    columns = [array('i') for _ in FIELDS]
+    last = [0] * len(FIELDS)
+    for j, pos in enumerate(positions):
+        if not pos.keys() <= {name for name, _ in FIELDS}:
+            raise ValueError('Unknown position field')
+        for i, (name, factor) in enumerate(FIELDS):
+            if name in pos:
+                flags[j] |= 1 << i
+                v = round(pos[name] * factor)
+                columns[i].append(v - last[i])
+                last[i] = v
+            else:
+                columns[i].append(0)
+
+    if sys.byteorder != 'little':
+        for column in columns:
+            column.byteswap()
+
+    data = HEADER.pack(MAGIC, len(positions), len(meta)) + meta + bytes(flags) + b''.join(column.tobytes() for column in columns)
+    if decode(data) != track:
+        raise ValueError('Track not representable in fixed point')
+
+    return gzip.compress(data, mtime=0)
+
+
+def decode_columns(data: bytes):
+    """
+    Decode binary track (gzip compressed or not) without building position dicts
+    Returns (track dict without positions, flags, list of value columns in order of FIELDS),
+    columns are float arrays with numpy, lists without. Values of absent fields are undefined.
+    """
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+
+    magic, n, meta_len = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a binary track')
+
+    ofs = HEADER.size
+    track = json.loads(data[ofs:ofs + meta_len].decode('utf-8'))
+    ofs += meta_len
+    flags = data[ofs:ofs + n]
+    ofs += n
+
+    if np is not None:
+        deltas = np.frombuffer(data, dtype='<i4', count=len(FIELDS) * n, offset=ofs).reshape(len(FIELDS), n)
+        return track, flags, [np.cumsum(column, dtype=np.int64) / factor for column, (_, factor) in zip(deltas, FIELDS)]
+
+    values = []
+    for name, factor in FIELDS:
+        column = array('i')
+        column.frombytes(data[ofs:ofs + 4*n])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        values.append([v / factor for v in accumulate(column)])
+        ofs += 4*n
+
+    return track, flags, values
+
+
+def positions(flags, values, indices=None):
+    """
+    Position dicts of decoded columns, only those at indices (sorted list) if given
+    """
+    if indices is not None:
+        flags = [flags[i] for i in indices]
+        values = [[column[i] for i in indices] if np is None else column[indices] for column in values]
+    if np is not None:
+        values = [column.tolist() for column in values]
+
+    result = []
+    for f, row in zip(flags, zip(*values)):
+        names, selectors = FLAG_FIELDS[f]
+        result.append(dict(zip(names, compress(row, selectors))))
+    return result
+
+
+def decode(data: bytes) -> dict:
+    """
+    Decode binary track (gzip compressed or not) into dict
+    """
+    track, flags, values = decode_columns(data)
+    track['positions'] = positions(flags, values)
+    return track
+
+
+def read(filename: str) -> dict:
+    """Read track file, binary or json"""
+    with open(filename, 'rb') as file:
+        data = file.read()
+
+    if filename.endswith(EXT):
+        return decode(data)
+
+    return json.loads(data)
+
+
+def summary(track: dict) -> dict:
+    """
+    Summary fields of track dict kept in main index entries: mode3a, emittercat and
+    bbox [min lat, min lon, max lat, max lon] of positions (None if there are none)
+    """
+    located = [pos for pos in track.get('positions', []) if 'lat' in pos and 'lon' in pos]
+    bbox = None
+    if located:
+        lats = [pos['lat'] for pos in located]
+        lons = [pos['lon'] for pos in located]
+        bbox = [min(lats), min(lons), max(lats), max(lons)]
+    return {'mode3a': track.get('mode3a'), 'emittercat': track.get('emittercat'), 'bbox': bbox}
+
+
+def binary_filename(filename: str) -> str:
+    """<name>.json -> <name>.trk.gz"""
+    if filename.endswith('.json'):
+        filename = filename[:-len('.json')]
+    return filename + EXT
+
+
+def json_filename(filename: str) -> str:
+    """<name>.trk.gz -> <name>.json"""
+    if filename.endswith(EXT):
+        return filename[:-len(EXT)] + '.json'
+    return filename
@@ -0,0 +1,107 @@
+from math import atan2, cos, degrees, radians, sqrt
+from .util import EDTF, EDTF_ELEVATION
+
+'''
+Traffic statistics per day with monthly and yearly rollups, file trafficstats.json next to the tracks
+
+Tracks are classified once when indexed (emitter category, runway), the main index entries
+carry the result, so day summaries are aggregated from index entries without reading tracks.
+Days indexed before, without summary, are backfilled by the next incremental genstats run.
+
+{'days': {'YYYY-MM-DD': summary}, 'months': {'YYYY-MM': summary}, 'years': {'YYYY': summary}}
+summary: tracks, hours (tracks by start hour UTC), emittercat (tracks by category code),
+runway (tracks by runway used), busiest_hour, busiest_hour_tracks, rollups also days and busiest_day
+'''
+
+TRAFFICSTATS = 'trafficstats.json'
+RUNWAYS = (('16', 160.0), ('34', 340.0))  # designator, true heading
+RUNWAY_RANGE = 2.0  # (km) from aerodrome reference point
+RUNWAY_HEIGHT = 1000.0  # (ft) above aerodrome
+RUNWAY_ANGLE = 40.0  # (deg) max difference of ground track to runway heading
+RUNWAY_MIN_DIST = 0.3   # (km) of aligned ground track for a runway movement
+
+
+def _distance_bearing(lat1, lon1, lat2, lon2):
+    """Distance (km, equirectangular) and true bearing (deg) from point 1 to point 2"""
+    dx = radians(lon2 - lon1) * cos(radians((lat1 + lat2) / 2))
+    dy = radians(lat2 - lat1)
+    return 6371.0 * sqrt(dx*dx + dy*dy), degrees(atan2(dx, dy)) % 360.0
+
+
+def _height(pos):
+    if 'geom_height' in pos:
+        return pos['geom_height']
+    if 'flight_lvl' in pos:
+        return pos['flight_lvl'] * 100.0
+    return None
+
+
+def track_runway(track: dict):
+    """
+    Runway used by track, None if it didn't follow a runway direction low near the aerodrome
+    Decided by the ground track length aligned to each runway direction.
+    """
+    aligned = {name: 0.0 for name, _ in RUNWAYS}
+    last = None
+    for pos in track['positions']:
+        height = _height(pos)
+        near = height is not None and height <= EDTF_ELEVATION + RUNWAY_HEIGHT \
+            and _distance_bearing(*EDTF, pos['lat'], pos['lon'])[0] <= RUNWAY_RANGE
+        if near and last is not None:
+            dist, bearing = _distance_bearing(last['lat'], last['lon'], pos['lat'], pos['lon'])
+            for name, heading in RUNWAYS:
+                if abs((bearing - heading + 180.0) % 360.0 - 180.0) <= RUNWAY_ANGLE:
+                    aligned[name] += dist
+        last = pos if near else None
+
+    name, dist = max(aligned.items(), key=lambda item: item[1])
+    return name if dist >= RUNWAY_MIN_DIST else None
+
+
+def _count(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def _set_busiest_hour(summary):
+    hours = summary['hours']
+    busiest = max(range(24), key=lambda hour: hours[hour])
+    summary['busiest_hour'] = busiest if hours[busiest] > 0 else None
+    summary['busiest_hour_tracks'] = hours[busiest]
+
+
+def day_summary(entries):
+    """
+    Summary of main index entries of a day
+    """
+    summary = {'tracks': len(entries), 'hours': [0] * 24, 'emittercat': {}, 'runway': {}}
+    for entry in entries:
+        summary['hours'][int(entry['start'][11:13])] += 1
+        _count(summary['emittercat'], str(entry.get('emittercat')))
+        if entry.get('runway') is not None:
+            _count(summary['runway'], entry['runway'])
+
+    _set_busiest_hour(summary)
+    return summary
+
+
+def rollup(days):
+    """
+    Summary of {date: day summary}
+    """
+    summary = {'tracks': 0, 'hours': [0] * 24, 'emittercat': {}, 'runway': {}, 'days': 0, 'busiest_day': None}
+    busiest = 0
+    for date, day in sorted(days.items()):
+        summary['tracks'] += day['tracks']
+        summary['hours'] = [a + b for a, b in zip(summary['hours'], day['hours'])]
+        for key in ('emittercat', 'runway'):
+            for k, n in day[key].items():
+                summary[key][k] = summary[key].get(k, 0) + n
+        if day['tracks'] > 0:
+            summary['days'] += 1
+        if day['tracks'] > busiest:
+            busiest = day['tracks']
+            summary['busiest_day'] = date
+
+    _set_busiest_hour(summary)
+    return summary
+
@@ -0,0 +1,34 @@
+import os
+import threading
+
+'''
+Small helpers and constants shared by the web app and the data preparation scripts
+'''
+
+EDTF = 48.02220, 7.83292    # aerodrome reference point (lat, lon) of the receiver site
+EDTF_ELEVATION = 801.0  # (ft)
+
+
+def parse_address(s, default_host=''):
+    """Split '[host:]port' into (host, port)"""
+    host, _, port = s.rpartition(':')
+    return host or default_host, int(port)
+
+
+def write_atomic(filename, write, binary=False):
+    """
+    Write file via temporary file and rename, so readers never see a partial file
+    write is called with the open temporary file. The temporary name is unique per process and thread,
+    concurrent writers of the same file don't interfere, the last rename wins.
+    """
+    tmpname = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpname, 'wb' if binary else 'w') as file:
+            write(file)
+        os.replace(tmpname, filename)
+    except BaseException:
+        try:
+            os.remove(tmpname)
+        except FileNotFoundError:
+            pass
+        raise
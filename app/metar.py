@@ -0,0 +1,102 @@
+from bisect import insort
+from collections import namedtuple
+from threading import Lock
+import os
+import re
+import time
+
+METARFILE = 'metars.txt'
+CHECK_INTERVAL = 10.0   # (s) between checks for a grown metar file
+
+# seconds since midnight and text first, as in the former (seconds, text) tuples
+Metar = namedtuple('Metar', ['seconds', 'text', 'wind_dir', 'wind_speed', 'wind_gust', 'visibility', 'ceiling'])
+
+WIND = re.compile(r'^(\d{3}|VRB)(\d{2,3})(?:G(\d{2,3}))?(KT|MPS)$')
+VISIBILITY = re.compile(r'^\d{4}$')
+CLOUDS = re.compile(r'^(BKN|OVC|VV)(\d{3})')
+MPS_TO_KT = 1.94384
+
+
+def parse_metar(line: str):
+    """
+    Parse line 'YYYYmmddHHMM METAR ...' of metar file
+    Return (date 'YYYYmmdd', Metar)
+    wind_dir in deg (None if variable), wind_speed, wind_gust in kt, visibility in m, ceiling in ft (None if no ceiling)
+    """
+    wind_dir = wind_speed = wind_gust = visibility = ceiling = None
+    for token in line[13:].split()[3:]:   # skip METAR, station, time
+        m = WIND.match(token)
+        if m and wind_speed is None:
+            factor = MPS_TO_KT if m.group(4) == 'MPS' else 1
+            wind_dir = int(m.group(1)) if m.group(1) != 'VRB' else None
+            wind_speed = round(int(m.group(2)) * factor)
+            wind_gust = round(int(m.group(3)) * factor) if m.group(3) else None
+        elif token == 'CAVOK':
+            visibility = 9999
+        elif VISIBILITY.match(token) and visibility is None:
+            visibility = int(token)
+        else:
+            m = CLOUDS.match(token)
+            if m:
+                height = int(m.group(2)) * 100
+                ceiling = height if ceiling is None else min(ceiling, height)
+
+    seconds = int(line[8:10])*3600 + int(line[10:12])*60
+    return line[:8], Metar(seconds, line[13:], wind_dir, wind_speed, wind_gust, visibility, ceiling)
+
+
+class MetarIndex:
+    """
+    Metar reports by day, sorted by time.
+    The metar file is only appended to: new lines are read incrementally, a shrunk file is read again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.days = {}  # 'YYYYmmdd' -> [Metar]
+        self._ofs = 0   # bytes of metar file read
+        self._next_check = 0.0
+        self._lock = Lock()
+        self.update()
+
+    def update(self):
+        """Read lines added to metar file"""
+        with self._lock:
+            try:
+                size = os.path.getsize(self.filename)
+            except FileNotFoundError:
+                return
+            if size < self._ofs:
+                self.days, self._ofs = {}, 0
+            if size == self._ofs:
+                return
+
+            with open(self.filename, 'rb') as file:
+                file.seek(self._ofs)
+                data = file.read(size - self._ofs)
+
+            complete = data.rfind(b'\n') + 1    # a partly written last line is read next time
+            days = dict(self.days)  # readers keep using the old dict and lists meanwhile
+            copied = set()
+            for line in data[:complete].decode('utf-8').splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                date, metar = parse_metar(line)
+                if date not in copied:
+                    days[date] = list(days.get(date, []))
+                    copied.add(date)
+                insort(days[date], metar)
+
+            self.days = days
+            self._ofs += complete
+
+    def get(self, date):
+        """
+        Return list of Metar of date
+        """
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + CHECK_INTERVAL
+            self.update()
+
+        return self.days.get(date.strftime('%Y%m%d'), [])
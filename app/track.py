@@ -1,12 +1,29 @@
 from dataclasses import dataclass
 from datetime import datetime
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from types import MappingProxyType
 import json
 import os
 import sys
+import time
+from adsbdata import daybundle, trackfile
+from adsbdata.lod import apply_lod, level_for_zoom
+from adsbdata.overlap import overlap_levels
 
 MAININDEX = 'mainindex.json'
 TRACKSDIR = os.environ.get('TRACKSDIR') + '/'
+DAYCACHE_BYTES = int(os.environ.get('DAYCACHE_BYTES', 64 * 1024 * 1024))  # size limit of day cache
+INDEX_CHECK_INTERVAL = 2.0  # (s) between checks for a changed main index
+BUNDLE_CACHE_SIZE = 16  # day bundles kept mapped, each holds a file descriptor
+
+IndexSnapshot = namedtuple('IndexSnapshot', ['mtime', 'days'])  # days is read only
+index_snapshot = None   # current main index, replaced as a whole on reload
 main_index = None
+_next_index_check = 0.0
+_reload_lock = Lock()
+bundles = OrderedDict()  # date -> mapped DayBundle, least recently used first, reopened when its file changes
+_bundles_lock = Lock()
 
 EMITTERCAT = {
     0: 'no info',
@@ -50,8 +67,8 @@ class Track:
     len_s: int = -1  # length in secs
     overlap_level: int = -1  # time overlap level with other tracks
     mode3a: str = None
-    reports = None
-    emittercat = None
+    emittercat: str = None
+    bbox: list = None   # [min lat, min lon, max lat, max lon] of positions
 
     def __post_init__(self):
         self.start_s = _seconds_since_midnight(self.start)
@@ -63,31 +80,10 @@ def resolve_overlap(tracks):
     Check for overlapping track intervals.
     Assign each track an level value according to other flights in same interval
     """
-    TIME, TYPE, TRCK = 0, 1, 2
-    times = []
-
-    for track in tracks.values():
-        times.append((track.start_s, 's', track))
-        times.append((track.start_s + track.len_s, 'e', track))
-
-    times = sorted(times, key=lambda entry: entry[TIME])
-
-    def find_level(lvls):
-        # find lowest possible level
-        for i in range(len(lvls)):
-            if i not in lvls:
-                return i
-
-        return len(lvls)
-
-    levels = []
-    for e in times:
-        if e[TYPE] == 's':
-            lvl = find_level(levels)
-            e[TRCK].overlap_level = lvl
-            levels.append(lvl)    # place track at level
-        else:
-            levels.remove(e[TRCK].overlap_level)   # remove track at level
+    tracks_list = list(tracks.values())
+    levels = overlap_levels([(track.start_s, track.len_s) for track in tracks_list])
+    for track, lvl in zip(tracks_list, levels):
+        track.overlap_level = lvl
 
     return tracks
 
@@ -103,36 +99,244 @@ def read_main_index():
     return data
 
 
-def read_track(filename: str) -> dict:
+def load_main_index():
     """
-    Read single track and return dict
+    Read main index into a new snapshot and make it the current one.
+    Dependent caches are cleared.
+    """
+    global index_snapshot, main_index
+    mtime = _mtime(TRACKSDIR + MAININDEX)   # before reading, a change while reading triggers another reload
+    snapshot = IndexSnapshot(mtime, MappingProxyType(read_main_index()))
+    index_snapshot = snapshot
+    main_index = snapshot.days
+    day_cache.clear()
+    return snapshot
+
+
+def get_index_snapshot():
+    """
+    Return current main index snapshot.
+    At most every INDEX_CHECK_INTERVAL seconds the index file is checked and reloaded if changed.
+    """
+    global _next_index_check
+    snapshot = index_snapshot
+    now = time.monotonic()
+    if now < _next_index_check:
+        return snapshot
+
+    _next_index_check = now + INDEX_CHECK_INTERVAL
+    if _mtime(TRACKSDIR + MAININDEX) != snapshot.mtime and _reload_lock.acquire(blocking=False):
+        try:    # other threads go on with the current snapshot meanwhile
+            snapshot = load_main_index()
+        finally:
+            _reload_lock.release()
+
+    return snapshot
+
+
+def get_main_index():
+    """Return days of current main index"""
+    return get_index_snapshot().days
+
+
+def track_path(filename: str):
+    """
+    Return path of stored track file, binary format preferred, None if there is no such track
     """
     filename = os.path.basename(filename)
-    if not filename.endswith('.json'):    
+    if not filename.endswith('.json'):
+        return None
+
+    for path in (TRACKSDIR + trackfile.binary_filename(filename), TRACKSDIR + filename):
+        if os.path.exists(path):
+            return path
+
+    return None
+
+
+def get_bundle(date: str):
+    """
+    Return mapped day bundle of date ('YYYY-MM-DD'), None if there is none
+    The last BUNDLE_CACHE_SIZE bundles used are kept. Mappings of evicted or replaced bundles
+    are closed with their last reference, requests still reading them are not disturbed.
+    """
+    path = TRACKSDIR + daybundle.bundle_filename(date)
+    mtime = _mtime(path)
+    with _bundles_lock:
+        bundle = bundles.pop(date, None)
+        if mtime is None:
+            return None
+
+        if bundle is None or bundle.mtime != mtime:
+            bundle = daybundle.DayBundle(path)
+        bundles[date] = bundle
+        while len(bundles) > BUNDLE_CACHE_SIZE:
+            bundles.popitem(last=False)
+
+    return bundle
+
+
+def _track_bundle(filename: str, bundle):
+    if bundle is None:
+        bundle = get_bundle(filename[:10])  # track filenames start with their date
+    return bundle if bundle is not None and filename in bundle else None
+
+
+def read_track_data(filename: str, bundle=None):
+    """
+    Return (data, format) of track as stored, format 'json' or 'trk', None if there is no such track
+    Tracks in the day bundle are preferred over single track files.
+    """
+    filename = os.path.basename(filename)
+    bundle = _track_bundle(filename, bundle)
+    if bundle is not None:
+        return bundle.get(filename)
+
+    path = track_path(filename)
+    if path is None:
+        return None
+
+    with open(path, 'rb') as file:
+        return file.read(), 'trk' if path.endswith(trackfile.EXT) else 'json'
+
+
+def read_track(filename: str, bundle=None, zoom=None) -> dict:
+    """
+    Read single track and return dict
+    With map zoom level only the positions of the matching level of detail are returned.
+    """
+    stored = read_track_data(filename, bundle)
+    if stored is None:
         return dict()
 
-    with open(TRACKSDIR + filename, 'r') as file:
-        data = json.load(file)
+    data, fmt = stored
+    if fmt != 'trk':
+        return apply_lod(json.loads(data), zoom)
 
-    return data
+    track, flags, values = trackfile.decode_columns(data)  # position dicts only of the level of detail
+    levels = track.get('lod')
+    indices = level_for_zoom(levels, zoom) if levels is not None and zoom is not None else None
+    track['positions'] = trackfile.positions(flags, values, indices)
+    if indices is not None:
+        track.pop('lod')
+        return track
+    return apply_lod(track, zoom)
 
 
-def read_day(date):
+class DayCache:
     """
-    Read all track files of a given date
+    LRU cache of days built by read_day(), limited by the approximate memory of the cached days in bytes.
+    An entry is only returned while the mtimes it was built with are unchanged.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._days = OrderedDict()  # date -> (mtimes, size, tracks)
+        self._lock = Lock()
+
+    def get(self, date, mtimes):
+        with self._lock:
+            entry = self._days.get(date)
+            if entry is None or entry[0] != mtimes:
+                self.misses += 1
+                return None
+            self._days.move_to_end(date)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, date, mtimes, size, tracks):
+        with self._lock:
+            if date in self._days:
+                self.size -= self._days.pop(date)[1]
+            if size > self.max_bytes:
+                return
+            self._days[date] = (mtimes, size, tracks)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size, _) = self._days.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._days.clear()
+            self.size = 0
+
+
+day_cache = DayCache(DAYCACHE_BYTES)
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def build_day(entries, bundle=None):
+    """
+    Track summaries of index entries
+    Index entries written by genstats carry mode3a, emittercat and bbox, track files are
+    only read for entries of older indexes lacking them.
     """
     tracks = {}
-    if date.strftime('%Y-%m-%d') in main_index:
-        for entry in main_index[date.strftime('%Y-%m-%d')]:
-            track = Track(_datetime_fromisoformat(entry['start']), _datetime_fromisoformat(entry['end']), entry['target_adr'], entry['target_id'], entry['filename'])
-            track_dict = read_track(track.filename)
-            track.reports = json.dumps(track_dict)
-            track.mode3a = oct(track_dict['mode3a'])[2:].rjust(4, '0') if track_dict['mode3a'] else ''
-            track.emittercat = EMITTERCAT.get(track_dict.get('emittercat'))
-            tracks[track.filename] = track
+    for entry in entries:
+        track = Track(_datetime_fromisoformat(entry['start']), _datetime_fromisoformat(entry['end']), entry['target_adr'], entry['target_id'], entry['filename'])
+        summary = entry if 'bbox' in entry else trackfile.summary(read_track(track.filename, bundle))
+        track.mode3a = oct(summary['mode3a'])[2:].rjust(4, '0') if summary.get('mode3a') else ''
+        track.emittercat = EMITTERCAT.get(summary.get('emittercat'))
+        track.bbox = summary.get('bbox')
+        tracks[track.filename] = track
 
     return resolve_overlap(tracks)
 
 
+def day_size(tracks):
+    """Approximate memory of a day of build_day() in bytes"""
+    size = sys.getsizeof(tracks)
+    for filename, track in tracks.items():
+        size += sys.getsizeof(filename) + sys.getsizeof(track) + sys.getsizeof(track.__dict__)
+        size += sum(sys.getsizeof(value) for value in track.__dict__.values())
+        if track.bbox:
+            size += sum(sys.getsizeof(value) for value in track.bbox)
+    return size
+
+
+def track_mtime(filename: str, bundle=None):
+    """
+    Return mtime (ns) of track file or of the day bundle holding it, None if there is no such track
+    """
+    filename = os.path.basename(filename)
+    bundle = _track_bundle(filename, bundle)
+    if bundle is not None:
+        return bundle.mtime
+
+    path = track_path(filename)
+    return _mtime(path) if path is not None else None
+
+
+def read_day(date):
+    """
+    Read all track files of a given date
+    Tracks are sliced from the day bundle if there is one, single track files are read otherwise.
+    Days are cached until the main index or the bundle changes. Track files are only checked
+    for entries of older indexes, whose summaries are read from the track files.
+    """
+    datestr = date.strftime('%Y-%m-%d')
+    snapshot = get_index_snapshot()
+    entries = snapshot.days.get(datestr, [])
+    bundle = get_bundle(datestr)
+    mtimes = (snapshot.mtime, bundle.mtime if bundle is not None else None)
+    mtimes += tuple(track_mtime(entry['filename'], bundle) for entry in entries if 'bbox' not in entry)
+
+    tracks = day_cache.get(datestr, mtimes)
+    if tracks is None:
+        tracks = build_day(entries, bundle)
+        day_cache.put(datestr, mtimes, day_size(tracks), tracks)
+
+    return tracks
+
+
 # read main index
-main_index = read_main_index()
+load_main_index()
@@ -1,64 +1,376 @@
 from app import app
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from calendar import monthrange
 from collections import OrderedDict
-from flask import render_template, abort
+from functools import lru_cache
+from threading import BoundedSemaphore
+from flask import render_template, abort, jsonify, request
+import gzip
 import json
-from .track import main_index, read_day, read_track
+import os
+import time
+import zlib
+from adsbdata import archiveindex, heatmap, livestream, trackfile, trafficstats
+from adsbdata.lod import lod_levels
+from adsbdata.util import parse_address
+from .metar import METARFILE, MetarIndex
+from .track import EMITTERCAT, TRACKSDIR, get_main_index, get_index_snapshot, read_day, read_track, read_track_data, track_mtime
 
 
-METARFILE = 'metars.txt'
-metar = []
+TRACK_MAX_AGE = 365 * 24 * 3600   # (s) recorded tracks never change
+DAY_MAX_AGE = 300  # (s) days may still get new tracks
+SEARCH_RADIUS = 2.0  # (km) default of /api/search
+HEAT_MAX_DAYS = 366
+HEAT_CHECK_INTERVAL = 2.0   # (s) between scans for changed heatmap days
+LIVE_MAX_CLIENTS = int(os.environ.get('LIVE_MAX_CLIENTS', 4))  # clients of /api/live, each holds a server thread
+LIVE_URL = os.environ.get('LIVE_URL', livestream.LIVE_PATH)    # live positions, e.g. of python3 -m adsbdata.livestream
+PROFILE_CACHE_SIZE = 256   # rendered flight profiles kept
+BINARY_CACHE_SIZE = 256    # json tracks encoded into the binary format kept
+PROFILE_MAX_WIDTH = 4000
 
-def read_metar():
-    with open(METARFILE) as f:
-        for l in f:
-            metar.append(l.strip())
+metar_index = MetarIndex(METARFILE)
+calendars = {}  # year -> (index mtime, calendar data)
+traffic = (None, {})  # (mtime, content of trafficstats.json)
+heat_mtimes = (0.0, {})  # (time of next check, {date: mtime})
+heat_tiles = heatmap.TileCache(TRACKSDIR)
+live_feed = livestream.LiveFeed(parse_address(os.environ['LIVE_ADDRESS'], '127.0.0.1') if 'LIVE_ADDRESS' in os.environ else livestream.LIVE_ADDRESS)
+live_clients = BoundedSemaphore(LIVE_MAX_CLIENTS)
 
 
-def get_metar(date):
-    ret = []
-    for l in metar:
-        if l.startswith(date.strftime('%Y%m%d')):
-            hour = int(l[8:10])
-            min = int(l[10:12])
-            ret.append((hour*3600+min*60, l[13:]))
-
-    return ret
-
-
-read_metar()
-
-
-def calendar_data(year : int):
+def calendar_data(year : int, days):
+    """
+    Months of year with number of tracks per day of main index days
+    """
     months = []
     names = ['Januar', 'Februar', 'März', 'April', 'Mai', 'Juni',
     'Juli', 'August', 'September', 'Oktober', 'November', 'Dezember']
 
     for m in range(1, 13):
-        month = { 'num': m, 'name': names[m-1] }
+        month = { 'num': m, 'name': names[m-1], 'days': [] }
         month['day_ofs'], month['day_num'] = monthrange(year, m)
 
         for day in range(1, month['day_num'] + 1):
-            yday = datetime(year, m, day).timetuple().tm_yday
-            if yday in main_index:
-                pass
+            datestr = '{:04}-{:02}-{:02}'.format(year, m, day)
+            month['days'].append({'num': day, 'date': datestr, 'tracks': len(days.get(datestr, ()))})
 
         months.append(month)
 
     return months
 
 
-def render_flight_profile_svg(track):
-    scale = 1.0
+def get_calendar(year : int):
+    """
+    Return (index mtime, calendar_data of year), computed once per main index snapshot
+    """
+    snapshot = get_index_snapshot()
+    cached = calendars.get(year)
+    if cached is None or cached[0] != snapshot.mtime:
+        cached = (snapshot.mtime, calendar_data(year, snapshot.days))
+        calendars[year] = cached
+
+    return cached
+
+
+def render_flight_profile_svg(track, width=None):
+    """
+    Height profile of track as a single filled path, one column per pixel of width (default 1 px per second)
+    Positions are placed over the whole width by their time_trans, by their index if it is missing.
+    Several positions on one pixel column are reduced to the highest.
+    """
     height = 100
-    svg = '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{}" height="{}">\n'.format(int((track['end'] - track['start']) / scale), height)
-    for x, posreport in enumerate(track['positions']):
+    positions = track['positions']
+    if width is None:
+        width = int(track['end'] - track['start'])
+    width = max(width, 1)
+
+    times = [posreport.get('time_trans') for posreport in positions]
+    if positions and None not in times:
+        elapsed = [(t - times[0]) % 86400.0 for t in times]   # time_trans is the time of day
+    else:
+        elapsed = list(range(len(positions)))
+    span = max(elapsed, default=0)
+
+    columns = []    # (x, max geom_height)
+    for t, posreport in zip(elapsed, positions):
+        x = int(t * (width - 1) / span) if span > 0 else 0
         geom_height = posreport.get('geom_height', 0.0)
-        svg += '<line style="stroke:#888; stroke-width:1;" x1="{}" y1="{}" x2="{}" y2="{}" shape-rendering="crispEdges" />\n'.format(x, height, x, height-geom_height / 100.0)
+        if columns and columns[-1][0] == x:
+            columns[-1][1] = max(columns[-1][1], geom_height)
+        else:
+            columns.append([x, geom_height])
+
+    steps = []  # [y, x end] runs of equal height, like the former 1px wide lines per position
+    for x, geom_height in columns:
+        y = round(height - geom_height / 100.0, 2)
+        if steps and steps[-1][0] == y:
+            steps[-1][1] = x + 1
+        else:
+            steps.append([y, x + 1])
+
+    path = ['M0 {}'.format(height)] + ['V{:g}H{}'.format(y, x) for y, x in steps] + ['V{}Z'.format(height)]
+
+    return ('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{w}" height="{h}" viewBox="0 0 {w} {h}" preserveAspectRatio="none">\n'
+        '<path style="fill:#888; stroke:none;" shape-rendering="crispEdges" d="{d}" />\n</svg>').format(w=width, h=height, d=''.join(path))
+
+
+@lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def flight_profile_svg(filename, mtime, width):
+    """Rendered profile of track file, cached per track version and width"""
+    return render_flight_profile_svg(read_track(filename), width)
+
+
+def cached_json(obj, etag, mtime_ns, max_age):
+    """
+    JSON response with validators and Cache-Control, 304 if client's copy is current
+    """
+    return cached_response(jsonify(obj), etag, mtime_ns, max_age)
+
+
+def cached_response(response, etag, mtime_ns, max_age):
+    response.set_etag(etag)
+    response.last_modified = datetime.utcfromtimestamp(mtime_ns // 10**9)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def track_summary(track):
+    """Compact dict of a track of read_day()"""
+    return {'filename': track.filename, 'start': track.start.isoformat(), 'end': track.end.isoformat(),
+        'adr': track.adr, 'id': track.id, 'mode3a': track.mode3a, 'emittercat': track.emittercat,
+        'start_s': track.start_s, 'len_s': track.len_s, 'overlap_level': track.overlap_level, 'bbox': track.bbox}
+
+
+@app.route('/api/day/<string:datestr>')
+def api_day(datestr):
+    try:
+        date = datetime.strptime(datestr, '%Y-%m-%d')
+    except ValueError:
+        abort(404)
+
+    snapshot = get_index_snapshot()
+    tracks = [track_summary(track) for track in read_day(date).values()]
+    return cached_json(tracks, '{}-{}'.format(datestr, snapshot.mtime), snapshot.mtime, DAY_MAX_AGE)
+
+
+@app.route('/api/calendar/<int:year>')
+def api_calendar(year):
+    if not 1 <= year <= 9999:
+        abort(404)
+
+    mtime, months = get_calendar(year)
+    return cached_json(months, 'calendar-{}-{}'.format(year, mtime), mtime, DAY_MAX_AGE)
+
+
+def parse_time(s):
+    """Time stamp of 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM:SS' (UTC), ValueError if neither"""
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(s, fmt).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            pass
+    raise ValueError('Invalid time {}'.format(s))
+
+
+@app.route('/api/search')
+def api_search():
+    """
+    Tracks passing within radius (km) of lat, lon between from and to (dates inclusive), optionally below max_height (ft)
+    e.g. /api/search?lat=48.0121&lon=7.8255&radius=2&from=2020-03-01&to=2020-03-31&max_height=1500
+    """
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radius = float(request.args.get('radius', SEARCH_RADIUS))
+        start = parse_time(request.args['from'])
+        to = request.args.get('to', request.args['from'])
+        end = parse_time(to) + (86400 if 'T' not in to else 0)
+        max_height = request.args.get('max_height', type=float)
+    except (KeyError, ValueError):
+        abort(400)
+
+    mtime = archiveindex.index_mtime(TRACKSDIR)
+    if mtime is None:
+        abort(404)
+
+    conn = archiveindex.connect(TRACKSDIR, readonly=True)
+    try:
+        results = archiveindex.search(conn, lat, lon, radius, start, end, max_height)
+    finally:
+        conn.close()
+
+    return cached_json(results, 'search-{}-{:08x}'.format(mtime, zlib.crc32(request.query_string)), mtime, DAY_MAX_AGE)
+
+
+@app.route('/api/aircraft/<string:key>')
+def api_aircraft(key):
+    """Track history of aircraft by icao address or callsign"""
+    mtime = archiveindex.index_mtime(TRACKSDIR)
+    if mtime is None:
+        abort(404)
+
+    conn = archiveindex.connect(TRACKSDIR, readonly=True)
+    try:
+        results = archiveindex.aircraft_history(conn, key)
+    finally:
+        conn.close()
+
+    return cached_json(results, 'aircraft-{}-{}'.format(key, mtime), mtime, DAY_MAX_AGE)
+
+
+def get_trafficstats():
+    """
+    Return (mtime, traffic statistics), reloaded when the file changed
+    """
+    global traffic
+    filename = TRACKSDIR + trafficstats.TRAFFICSTATS
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None, {}
+
+    if mtime != traffic[0]:
+        with open(filename, 'r') as file:
+            traffic = (mtime, json.load(file))
+
+    return traffic
+
+
+@app.route('/api/stats/<string:period>')
+def api_stats(period):
+    """Traffic summary of a day (YYYY-MM-DD), month (YYYY-MM) or year (YYYY)"""
+    kind = {10: 'days', 7: 'months', 4: 'years'}.get(len(period))
+    mtime, stats = get_trafficstats()
+    if kind is None or period not in stats.get(kind, {}):
+        abort(404)
+
+    summary = dict(stats[kind][period])
+    summary['emittercat_names'] = {EMITTERCAT.get(int(cat) if cat.isdigit() else None, 'unknown'): n
+        for cat, n in summary['emittercat'].items()}
+    return cached_json(summary, 'stats-{}-{}'.format(period, mtime), mtime, DAY_MAX_AGE)
+
+
+def get_heat_mtimes():
+    """Return {date: mtime} of heatmap days, rescanned at most every HEAT_CHECK_INTERVAL seconds"""
+    global heat_mtimes
+    now = time.monotonic()
+    if now >= heat_mtimes[0]:
+        heat_mtimes = (now + HEAT_CHECK_INTERVAL, heatmap.day_mtimes(TRACKSDIR))
+    return heat_mtimes[1]
+
+
+@app.route('/heatmap/<string:first>/<string:last>/<int:z>/<int:x>/<int:y>.png')
+def heatmap_tile(first, last, z, x, y):
+    """Density tile of tracks of days first to last (YYYY-MM-DD, inclusive)"""
+    try:
+        first_date = datetime.strptime(first, '%Y-%m-%d')
+        num_days = (datetime.strptime(last, '%Y-%m-%d') - first_date).days + 1
+    except ValueError:
+        abort(404)
+    if heatmap.np is None or not 0 < num_days <= HEAT_MAX_DAYS or not 0 <= z <= heatmap.BASE_ZOOM \
+            or not (0 <= x < 2**z and 0 <= y < 2**z):
+        abort(404)
+
+    dates = [(first_date + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(num_days)]
+    first, last = dates[0], dates[-1]   # as normalized dates
+    mtimes = get_heat_mtimes()
+    version = heatmap.range_version(dates, mtimes)
+    png = heatmap.get_tile(TRACKSDIR, dates, mtimes, z, x, y, heat_tiles if heatmap.cached_range(first, last) else None)
+    response = app.response_class(png, mimetype='image/png')
+    mtime = max((mtimes[date] for date in dates if date in mtimes), default=0)
+    return cached_response(response, 'heat-{}-{}-{}-{}-{}-{}'.format(first, last, version, z, x, y), mtime, DAY_MAX_AGE)
+
+
+@app.route('/api/live')
+def api_live():
+    """
+    Server sent events with positions of active tracks, fed by tracker.py --live
+    A full 'snapshot' first, then merged 'delta' events at most every ?interval= seconds
+    For development: each client holds a server thread, at most LIVE_MAX_CLIENTS are served.
+    The feed binds LIVE_ADDRESS, other processes can't and answer 503. Production serves /api/live
+    with python3 -m adsbdata.livestream.
+    """
+    try:
+        live_feed.start()
+    except OSError:
+        abort(503, 'live feed address in use, /api/live needs a single server process')
+    if not live_clients.acquire(blocking=False):
+        abort(503, 'too many live clients')
+
+    interval = livestream.client_interval(request.args.get('interval', livestream.CLIENT_MIN_INTERVAL, type=float))
+    last_seq = request.headers.get('Last-Event-ID', type=int)
+    response = app.response_class(livestream.sse_events(live_feed, last_seq, interval), mimetype='text/event-stream')
+    response.call_on_close(live_clients.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'    # no proxy buffering
+    return response
+
+
+@app.route('/api/track/<string:filename>')
+def api_track(filename):
+    mtime = track_mtime(filename)
+    if mtime is None:
+        abort(404)
+
+    zoom = request.args.get('zoom', type=int)
+    track = read_track(filename, zoom=zoom)
+    track.pop('report', None)
+    return cached_json(track, '{}-{}-{}'.format(filename, mtime, zoom), mtime, TRACK_MAX_AGE)
+
+
+@lru_cache(maxsize=BINARY_CACHE_SIZE)
+def binary_track(filename, mtime):
+    """
+    Track file in binary format (gzip compressed), json tracks are encoded, with levels of detail.
+    None if the track can't be represented in the binary format.
+    """
+    data, fmt = read_track_data(filename)
+    if fmt == 'trk':
+        return data
+
+    track = json.loads(data)
+    if 'lod' not in track:
+        track['lod'] = lod_levels(track['positions'])
+    try:
+        return trackfile.encode(track)
+    except ValueError:
+        return None
+
+
+@app.route('/api/track/<string:name>.trk')
+def api_track_binary(name):
+    """Track in binary format, see trackfile.py. Sent gzip compressed if the client accepts it."""
+    mtime = track_mtime(name + '.json')
+    if mtime is None:
+        abort(404)
+    data = binary_track(name + '.json', mtime)
+    if data is None:
+        abort(404)
+
+    encoding = 'gzip' if request.accept_encodings['gzip'] > 0 else 'identity'
+    if encoding == 'identity':
+        data = gzip.decompress(data)
+    response = app.response_class(data, mimetype='application/octet-stream')
+    if encoding == 'gzip':
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return cached_response(response, '{}-{}-{}'.format(name, mtime, encoding), mtime, TRACK_MAX_AGE)
+
+
+@app.route('/profile/<string:name>.svg')
+def profile_svg(name):
+    """Flight profile of track, optional ?width= in pixels"""
+    mtime = track_mtime(name + '.json')
+    if mtime is None:
+        abort(404)
+
+    width = request.args.get('width', type=int)
+    if width is not None:
+        width = min(max(width, 1), PROFILE_MAX_WIDTH)
 
-    svg += '</svg>'
-    return svg
+    svg = flight_profile_svg(name + '.json', mtime, width)
+    response = app.response_class(svg, mimetype='image/svg+xml')
+    return cached_response(response, '{}-{}-{}'.format(name, mtime, width), mtime, TRACK_MAX_AGE)
 
 
 @app.route('/test')
@@ -71,31 +383,32 @@ def favicon():
     abort(404)
 
 
-@app.route('/', defaults={'datestr': '2020-03-15', 'adr': None})
+@app.route('/', defaults={'datestr': None, 'adr': None})
 @app.route('/<string:datestr>', defaults={'adr': None})
 @app.route('/<string:datestr>/<string:adr>')
 def index(datestr, adr):
+    if datestr is None:     # latest day with tracks
+        datestr = max(get_main_index(), default=datetime.utcnow().strftime('%Y-%m-%d'))
     date = datetime.strptime(datestr, '%Y-%m-%d')
 
     selected_track = None
     selected_filename = None
-    svg = None
     # read all tracks of day
     day_tracks = read_day(date)
 
     if adr is not None:
         selected_track = read_track(adr)
         selected_filename = adr
-        svg = render_flight_profile_svg(selected_track)
 
-    data = {'months': calendar_data(2020),
-        'main_index': main_index,
+    month_days = monthrange(date.year, date.month)[1]
+    data = {'months': get_calendar(date.year)[1],
+        'heat_range': (date.strftime('%Y-%m-01'), date.strftime('%Y-%m-') + str(month_days)),
         'date': datestr,
         'day_tracks': day_tracks,
         'selected_track': selected_track,
         'selected_filename': selected_filename,
-        'metar': get_metar(date),
-        'svg': svg }
+        'live_url': LIVE_URL,
+        'metar': metar_index.get(date) }
 
     return render_template('index.html', data=data)
 
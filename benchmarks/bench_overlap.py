@@ -0,0 +1,72 @@
+import argparse
+import random
+import sys
+import time
+
+from adsbdata.overlap import overlap_levels
+
+'''
+Benchmark overlap_levels against the former list based resolve_overlap on synthetic days
+'''
+
+
+def overlap_levels_list(intervals):
+    """Former implementation of track.resolve_overlap on (start, length) intervals"""
+    TIME, TYPE, IDX = 0, 1, 2
+    times = []
+    for i, (start, length) in enumerate(intervals):
+        times.append((start, 's', i))
+        times.append((start + length, 'e', i))
+
+    times = sorted(times, key=lambda entry: entry[TIME])
+
+    def find_level(lvls):
+        for i in range(len(lvls)):
+            if i not in lvls:
+                return i
+        return len(lvls)
+
+    result = [-1] * len(intervals)
+    levels = []
+    for e in times:
+        if e[TYPE] == 's':
+            lvl = find_level(levels)
+            result[e[IDX]] = lvl
+            levels.append(lvl)
+        else:
+            levels.remove(result[e[IDX]])
+
+    return result
+
+
+def synthetic_day(num_tracks, mean_len, seed):
+    """Tracks between 04:30 and 20:30, distinct start and end times"""
+    rnd = random.Random(seed)
+    return [(rnd.uniform(4.5*3600, 20.5*3600), rnd.expovariate(1.0 / mean_len) + 1e-3) for _ in range(num_tracks)]
+
+
+def timed(func, intervals, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func(intervals)
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark overlap level assignment')
+    parser.add_argument('--tracks', dest='tracks', type=int, nargs='+', default=[100, 1000, 3000, 10000], help='Tracks per day')
+    parser.add_argument('--length', dest='length', type=float, default=1800.0, help='Mean track length (s)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='Runs per measurement, best is reported')
+
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>12} {:>12} {:>8}'.format('tracks', 'levels', 'list (ms)', 'heap (ms)', 'speedup'))
+    for n in args.tracks:
+        intervals = synthetic_day(n, args.length, n)
+        t_list, levels_list = timed(overlap_levels_list, intervals, args.repeat)
+        t_heap, levels_heap = timed(overlap_levels, intervals, args.repeat)
+        if levels_list != levels_heap:
+            sys.exit('Levels differ for {} tracks'.format(n))
+        print('{:>8} {:>8} {:>12.2f} {:>12.2f} {:>8.1f}'.format(n, max(levels_heap) + 1, t_list * 1000, t_heap * 1000, t_list / t_heap))
@@ -1,66 +1,161 @@
 import sys
-import cat21
+import os
+import mmap
+import struct
+from . import cat21
 import lzma
 import argparse
 import json
+try:
+    import numpy as np   # only needed for decoding into columns
+except ImportError:
+    np = None
 
 
-def records_from_blocks(data):
+CHUNKSIZE = 4 * 1024 * 1024   # read size for compressed recordings
+COLUMN_CHUNK = 65536    # records per array of columns_from_blocks()
+HEADER = struct.Struct('>BIQ')   # asterixRecorder block header: type, total size, stamp (ms)
+
+
+def cat21_sections(data):
     """
-    yields list of records of block(s)
+    yields data sections of the cat21 asterix blocks in data as memoryview
     """
+    data = memoryview(data)   # slice blocks without copying
+    ofs, end = 0, len(data)
+    while end - ofs >= 3:
+        cat = data[ofs]
+        blocksize = data[ofs+1] << 8 | data[ofs+2]
+        if blocksize < 3 or end - ofs < blocksize:
+            break
+        if cat == 21:
+            yield data[ofs+3:ofs+blocksize]
 
-    while True:
-        if len(data) < 3:
+        ofs += blocksize
+
+
+def records_from_blocks(data, fields=None, raw=False):
+    """
+    yields list of records of block(s)
+    fields, raw: see cat21.decode_records
+    """
+    for section in cat21_sections(data):
+        try:
+            yield cat21.decode_records(section, fields, raw)
+        except (KeyError, IndexError):   # unknown item or truncated record
             break
-        cat = int.from_bytes(data[0:1], byteorder='big', signed=False)
-        blocksize = int.from_bytes(data[1:3], byteorder='big', signed=False)
-        if len(data) < blocksize:
+
+
+def blocks_from_buffer(buf, ofs=0):
+    """
+    Yield blocks of asterixRecorder data in buf as (stamp, memoryview)
+    Returns offset of the first incomplete block
+    """
+    end = len(buf)
+    while end - ofs >= HEADER.size:
+        _, size, stamp = HEADER.unpack_from(buf, ofs)
+        if size < HEADER.size or end - ofs < size:
             break
-        if cat == 21:
-            try:
-                yield cat21.decode_records(data[3:blocksize])
-            except KeyError:
-                break
+        yield stamp/1000.0, buf[ofs+HEADER.size:ofs+size]
+        ofs += size
 
-        data = data[blocksize:]
+    return ofs
 
 
 def blocks_from_recording(file):
     """Return blocks from asterixRecorder as iterable"""
+    rest = b''
     while True:
-        header = file.read(13)
-        if len(header) < 13:
+        chunk = file.read(CHUNKSIZE)
+        if not chunk:
             break
-        stamp = int.from_bytes(header[5:13], byteorder='big', signed=False)
-        data = file.read(int.from_bytes(header[1:5], byteorder='big', signed=False) - 13)
-        yield stamp/1000.0, data
+        buf = memoryview(rest + chunk if rest else chunk)
+        ofs = yield from blocks_from_buffer(buf)
+        rest = bytes(buf[ofs:])    # carry incomplete block over to next chunk
 
 
-def iterate_records(filelike):
+def iterate_blocks(blocks, fields=None, raw=False):
     """
-    Iterate of records of a asterix file
-    Return dict
+    Iterate over records of (stamp, data) blocks
+    Return dict, only with items named in fields if given
     """
-    for stamp, blockdata in blocks_from_recording(filelike):
-        for rec_list in records_from_blocks(blockdata):
+    for stamp, blockdata in blocks:
+        for rec_list in records_from_blocks(blockdata, fields, raw):
             for rec in rec_list:
                 rec['block_stamp'] = stamp  # add block time stamp to every record in block
                 yield rec
 
 
-def process_file(filename):
+def iterate_records(filelike, fields=None):
     """
-    Process asterix file (optional .xz compressed)
+    Iterate of records of a asterix file
+    Return dict, only with items named in fields if given
+    """
+    return iterate_blocks(blocks_from_recording(filelike), fields)
+
+
+def blocks_from_file(filename):
+    """
+    Return blocks of asterixRecorder file (optional .xz compressed) as iterable of (stamp, memoryview)
+    Uncompressed files are memory mapped.
     """
     if filename[-3:] == '.xz':
-        fopen = lzma.open
-    else:
-        fopen = open
+        with lzma.open(filename, 'rb') as file:
+            yield from blocks_from_recording(file)
+        return
+
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # the mapping is closed when the last block slice of it is released
+    yield from blocks_from_buffer(memoryview(mm))
+
+
+def process_file(filename, fields=None, raw=False):
+    """
+    Process asterix file (optional .xz compressed)
+    fields: optional item names to decode, None decodes all
+    raw: add undecoded records as bytes under 'raw'
+    """
+    return iterate_blocks(blocks_from_file(filename), fields, raw)
+
 
-    with fopen(filename, 'rb') as file:
-        for rec in iterate_records(file):
-            yield rec
+def columns_from_blocks(blocks, chunk=COLUMN_CHUNK):
+    """
+    Decode records of (stamp, data) blocks into numpy columns, about chunk records at a time
+    Yields (columns, records, data): structured array of cat21.COLUMN_DTYPE, one row per record,
+    and (start, end, item offsets) of the records in the bytearray data of their blocks.
+    """
+    data, records, stamps = bytearray(), [], []
+    for stamp, blockdata in blocks:
+        for section in cat21_sections(blockdata):
+            start = len(data)
+            data += section
+            try:
+                located = cat21.locate_records(data, start)
+            except (KeyError, IndexError):   # unknown item or truncated record
+                del data[start:]
+                break
+            records += located
+            stamps += [stamp] * len(located)
+
+        if len(records) >= chunk:
+            yield cat21.decode_columns(data, records, stamps), records, data
+            data, records, stamps = bytearray(), [], []
+
+    if records:
+        yield cat21.decode_columns(data, records, stamps), records, data
+
+
+def process_file_columns(filename):
+    """
+    Decode asterix file (optional .xz compressed) into a numpy structured array of cat21.COLUMN_DTYPE,
+    one row per record
+    """
+    chunks = [columns for columns, _, _ in columns_from_blocks(blocks_from_file(filename))]
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=cat21.COLUMN_DTYPE)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+
+from adsbdata import daybundle, trackfile
+
+'''
+Build day bundles (<date>.bundle) from the track files of the main index
+'''
+
+MAININDEX = 'mainindex.json'
+
+
+def stored_track(tracksdir, filename):
+    """
+    Return (path, format) of track file, binary format preferred, None if there is none
+    """
+    for name, fmt in ((trackfile.binary_filename(filename), 'trk'), (filename, 'json')):
+        path = os.path.join(tracksdir, name)
+        if os.path.exists(path):
+            return path, fmt
+
+    return None
+
+
+def build_bundle(tracksdir, date, entries, force=False, remove=False):
+    """
+    Write bundle of date if missing or outdated
+    Tracks without a single file are taken from the existing bundle.
+    Return number of bundled tracks, None if the bundle was up to date
+    """
+    filename = os.path.join(tracksdir, daybundle.bundle_filename(date))
+    old = daybundle.DayBundle(filename) if os.path.exists(filename) else None
+
+    sources = {entry['filename']: stored_track(tracksdir, entry['filename']) for entry in entries}
+    if not force and old is not None and all(name in old for name in sources) \
+            and all(os.stat(src[0]).st_mtime_ns <= old.mtime for src in sources.values() if src is not None):
+        return None
+
+    tracks = []
+    for name, src in sources.items():
+        if src is not None:
+            with open(src[0], 'rb') as file:
+                tracks.append((name, file.read(), src[1]))
+        elif old is not None and name in old:
+            tracks.append((name,) + old.get(name))
+        else:
+            print('Missing track {}'.format(name))
+
+    daybundle.write(filename, tracks)
+
+    if remove:
+        for src in sources.values():
+            if src is not None:
+                os.remove(src[0])
+
+    return len(tracks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build day bundles from track files')
+    parser.add_argument('dates', help='date(s) YYYY-MM-DD, all days of main index if omitted', nargs='*')
+    parser.add_argument('--tracksdir', dest='tracksdir', default='tracks', help='Directory of track files and main index')
+    parser.add_argument('--force', dest='force', action='store_true', help='Rebuild bundles even if up to date')
+    parser.add_argument('--remove', dest='remove', action='store_true', help='Remove single track files after bundling')
+
+    args = parser.parse_args()
+
+    with open(os.path.join(args.tracksdir, MAININDEX), 'r') as file:
+        main_index = json.load(file)
+
+    for date in args.dates or main_index.keys():
+        n = build_bundle(args.tracksdir, date, main_index.get(date, []), args.force, args.remove)
+        if n is None:
+            print('{} up to date'.format(date))
+        else:
+            print('{} {} tracks'.format(date, n))
@@ -1,11 +1,13 @@
-from bitstring import Bits
-from functools import partial
-
 '''
 Asterix Cat21 decoder
 (c) Volker Poplawski 2019
 '''
 
+try:
+    import numpy as np   # only needed for decoding into columns
+except ImportError:
+    np = None
+
 def mask(n):
     return (1 << n) - 1
 
@@ -21,157 +23,237 @@ def bitextrct(v: bytes, s: int, e: int, signed = False):
     return i
 
 
-def decodeIcaoStr(data):
-    """decode icao 8 character string encoded in 6 bytes"""
-    chrs = ' ABCDEFGHIJKLMNOPQRSTUVWXYZ                     0123456789      '
-    b = Bits(bytes=data, length=6 * 8)
-    return ''.join([chrs[b[i*6:i*6+6].uint] for i in range(8)])
+FIXED, VARIABLE, REPETITIVE, EXPLICIT, COMPOUND = range(5)    # kinds of field length
 
+ICAO_CHRS = ' ABCDEFGHIJKLMNOPQRSTUVWXYZ                     0123456789      '
 
-def count_extends(data):
-    """Count number of extended bytes"""
-    return next((i + 1 for i, b in enumerate(data) if (b & 0x1) == 0), 0)
+# FRNs encoded by a single fspec byte, for each byte value and extension index
+FSPEC_FRNS = [[tuple(j + i*7 + 1 for j in range(7) if n & (1 << (7 - j))) for n in range(256)] for i in range(16)]
+
+
+def int8(data, ofs):
+    v = data[ofs]
+    return v - 0x100 if v & 0x80 else v
+
+
+def int16(data, ofs):
+    v = data[ofs] << 8 | data[ofs+1]
+    return v - 0x10000 if v & 0x8000 else v
+
+
+def int24(data, ofs):
+    v = data[ofs] << 16 | data[ofs+1] << 8 | data[ofs+2]
+    return v - 0x1000000 if v & 0x800000 else v
+
+
+def uint16(data, ofs):
+    return data[ofs] << 8 | data[ofs+1]
 
 
-def decode_fspec(data):
-    """Returns FRN from Fspec section as list()"""
-    numExtends = count_extends(data)
-    iterbits = lambda n: (7 - i for i in range(7, 0, -1) if n & (1 << i))  # iterate over non-zero bit indexes
-    return [j + i*7 + 1 for i in range(numExtends) for j in iterbits(data[i])], numExtends
+def uint32(data, ofs):
+    return data[ofs] << 24 | data[ofs+1] << 16 | data[ofs+2] << 8 | data[ofs+3]
 
 
-def iterate_fields(uap, data, out):
-    frns, size = decode_fspec(data)
-    data = data[size:]           # skip fspec section
+def decodeIcaoStr(data, ofs=0):
+    """decode icao 8 character string encoded in 6 bytes"""
+    v = int.from_bytes(data[ofs:ofs+6], byteorder='big', signed=False)
+    return ''.join([ICAO_CHRS[(v >> s) & 0x3f] for s in range(42, -1, -6)])
+
+
+def count_extends(data, ofs=0):
+    """Count number of extended bytes"""
+    n = 1
+    while data[ofs] & 0x1:
+        ofs += 1
+        n += 1
+    return n
+
+
+def decode_fspec(data, ofs=0):
+    """Returns FRN from Fspec section as list() and offset of first field"""
+    frns = []
+    i = 0
+    while True:
+        b = data[ofs]
+        frns += FSPEC_FRNS[i][b]
+        ofs += 1
+        if not b & 0x1:
+            return frns, ofs
+        i += 1
+
+
+def iterate_fields(plan, data, ofs, out):
+    """Decode fields of a record (or compound item) at ofs, return offset past it"""
+    frns, ofs = decode_fspec(data, ofs)
     for frn in frns:
-        name, len_type, *cb = uap[frn]
-        if len(cb) > 0:                     # callback function for this frn?
-            out[name] = cb[0](data)
-        length = len_type(data, out)
-        size += length
-        data = data[length:]           # advance to next field
-    return size
+        name, kind, arg, cb = plan[frn]
+        if cb is not None:                  # callback function for this frn?
+            out[name] = cb(data, ofs)
+        if kind == FIXED:
+            ofs += arg
+        elif kind == VARIABLE:
+            ofs += count_extends(data, ofs)
+        elif kind == REPETITIVE:
+            ofs += data[ofs] * arg + 1
+        elif kind == EXPLICIT:
+            ofs += data[ofs]
+        else:
+            ofs = iterate_fields(arg, data, ofs, out)
+    return ofs
 
 
 def fixed(size):
-    return lambda *args: size
+    return FIXED, size
 
 
 def variable():
-    return lambda data, *args: count_extends(data)
+    return VARIABLE, None
 
 
 def repetive(size):
-    return lambda data, *args: data[0] * size + 1
+    return REPETITIVE, size
 
 
 def explicit():
-    return lambda data, *args: data[0]
+    return EXPLICIT, None
 
 
 def compound(uap):
-    return partial(iterate_fields, uap)    # bind 'uap' to first parameter
+    return COMPOUND, uap
+
+
+def compile_uap(uap, fields=None):
+    """
+    Compile uap table into a decoding plan.
+    Maps frn to (name, length kind, size or sub plan, callback or None)
+    If fields is given only items named therein get their callback, all others are skipped by length.
+    """
+    plan = {}
+    for frn, (name, (kind, arg), *cb) in uap.items():
+        if kind == COMPOUND:
+            arg = compile_uap(arg, fields)
+        wanted = len(cb) > 0 and (fields is None or name in fields)
+        plan[frn] = (name, kind, arg, cb[0] if wanted else None)
+    return plan
+
+
+def item_offset(data, ofs):
+    return ofs
+
+
+def compile_locator(uap, frns):
+    """
+    Compile uap table into a plan for iterate_fields() which stores the offset of the items frns
+    under their frn instead of decoding them. All other items are skipped by length.
+    """
+    plan = compile_uap(uap, ())
+    for frn in frns:
+        _, kind, arg, _ = plan[frn]
+        plan[frn] = (frn, kind, arg, item_offset)
+    return plan
 
 
 def extrct(data, ofs, len, signed=True):
     return int.from_bytes(data[ofs:ofs+len], byteorder='big', signed=True)
 
 
-def target_report(data):
-    b = Bits(bytes=data, length=8)
-    d = {'ATP': b[0:3].uint, 'ARC': b[3:5].uint, 'RC': b[5:6].uint, 'RAB': b[6:7].uint}
-    if b[7]:
-        b = Bits(bytes=data[1:], length=8)
-        d.update({'DCR': b[0:1].uint, 'GBS': b[1:2].uint, 'SIM': b[2:3].uint, 'TST': b[3:4].uint, 'SAA': b[4:5].uint, 'CL': b[5:7].uint})
+def target_report(data, ofs):
+    b = data[ofs]
+    d = {'ATP': b >> 5, 'ARC': (b >> 3) & 0x3, 'RC': (b >> 2) & 0x1, 'RAB': (b >> 1) & 0x1}
+    if b & 0x1:
+        b = data[ofs+1]
+        d.update({'DCR': b >> 7, 'GBS': (b >> 6) & 0x1, 'SIM': (b >> 5) & 0x1, 'TST': (b >> 4) & 0x1, 'SAA': (b >> 3) & 0x1, 'CL': (b >> 1) & 0x3})
     return d
 
 
-def ac_op_state(data):
-    b = Bits(bytes=data, length=8)
-    return {'RA': b[0:1].uint, 'TC': b[1:3].uint, 'TS': b[3:4].uint, 'ARV': b[4:5].uint,
-        'CDTI': b[5:6].uint, 'TCAS': b[6:7].uint, 'SA': b[7:8].uint
+def ac_op_state(data, ofs):
+    b = data[ofs]
+    return {'RA': b >> 7, 'TC': (b >> 5) & 0x3, 'TS': (b >> 4) & 0x1, 'ARV': (b >> 3) & 0x1,
+        'CDTI': (b >> 2) & 0x1, 'TCAS': (b >> 1) & 0x1, 'SA': b & 0x1
     }
 
 
-def time_recp_pos_hp(data):
-    return {'FSI': Bits(bytes=data, length=8)[0:2].uint, 'time': Bits(bytes=data, length=4*8)[2:].uint / 2**30}
+def time_recp_pos_hp(data, ofs):
+    v = uint32(data, ofs)
+    return {'FSI': v >> 30, 'time': (v & 0x3fffffff) / 2**30}
 
 
-def time_recp_velo_hp(data):
-    return {'FSI': Bits(bytes=data, length=8)[0:2].uint, 'time': Bits(bytes=data, length=4*8)[2:].uint / 2**30}
+def time_recp_velo_hp(data, ofs):
+    v = uint32(data, ofs)
+    return {'FSI': v >> 30, 'time': (v & 0x3fffffff) / 2**30}
 
 
-def ground_vector(data):
-    b = Bits(bytes=data, length=4*8)
-    return {'RE': b[0:1].uint, 'speed': round(b[1:16].uint / 2**14, 3), 'angle': round(b[16:32].uint * (360.0/2**16), 3)}
+def ground_vector(data, ofs):
+    v = uint32(data, ofs)
+    return {'RE': v >> 31, 'speed': round(((v >> 16) & 0x7fff) / 2**14, 3), 'angle': round((v & 0xffff) * (360.0/2**16), 3)}
 
 
-def baro_vert_rate(data):
-    b = Bits(bytes=data, length=8)
-    return {'RE': b[0:1].uint, 'rate': b[1:16].int / 6.25}
+def vert_rate(data, ofs):
+    # rate is taken from the first octet only (7 bit signed), as always
+    b = data[ofs]
+    return {'RE': b >> 7, 'rate': ((b & 0x7f) - 0x80 if b & 0x40 else b & 0x7f) / 6.25}
 
 
-def geom_vert_rate(data):
-    b = Bits(bytes=data, length=8)
-    return {'RE': b[0:1].uint, 'rate': b[1:16].int / 6.25}
+baro_vert_rate = vert_rate
+geom_vert_rate = vert_rate
 
 
-def quality_ind(data):
-    b = Bits(bytes=data, length=8)
-    d = {'NUCr': b[0:4].uint, 'NUCp': b[4:7].uint}
-    if b[7]:
-        b = Bits(bytes=data[1:], length=8)
-        d.update({'NICBARO': b[0:1].uint, 'SIL': b[1:3].uint, 'NACp': b[3:7].uint})
-    if b[7]:
-        b = Bits(bytes=data[2:], length=8)
-        d.update({'SILs': b[2:3].uint, 'SDA': b[3:5].uint, 'GVA': b[5:7].uint})
-    if b[7]:
-        b = Bits(bytes=data[3:], length=8)
-        d.update({'PIC': b[0:4].uint})
+def quality_ind(data, ofs):
+    b = data[ofs]
+    d = {'NUCr': b >> 4, 'NUCp': (b >> 1) & 0x7}
+    if b & 0x1:
+        b = data[ofs+1]
+        d.update({'NICBARO': b >> 7, 'SIL': (b >> 5) & 0x3, 'NACp': (b >> 1) & 0xf})
+        if b & 0x1:
+            b = data[ofs+2]
+            d.update({'SILs': (b >> 5) & 0x1, 'SDA': (b >> 3) & 0x3, 'GVA': (b >> 1) & 0x3})
+            if b & 0x1:
+                d.update({'PIC': data[ofs+3] >> 4})
     return d
 
 
-def selected_alt(data):
-    b = Bits(bytes=data, length=2*8)
-    return {'SAS': b[0:1].uint, 'src': b[1:3].uint, 'alt': b[3:16].int * 25}
+def selected_alt(data, ofs):
+    v = uint16(data, ofs)
+    alt = v & 0x1fff
+    return {'SAS': v >> 15, 'src': (v >> 13) & 0x3, 'alt': (alt - 0x2000 if alt & 0x1000 else alt) * 25}
 
 
-def target_state(data):
-    b = Bits(bytes=data, length=8)
-    return {'ICF': b[0:1].uint, 'LNAV': b[1:2].uint, 'ME': b[2:3].uint, 'PS': b[3:6].uint, 'SS': b[6:8].uint}
+def target_state(data, ofs):
+    b = data[ofs]
+    return {'ICF': b >> 7, 'LNAV': (b >> 6) & 0x1, 'ME': (b >> 5) & 0x1, 'PS': (b >> 2) & 0x7, 'SS': b & 0x3}
 
 
-def mops_ver(data):
-    b = Bits(bytes=data, length=8)
-    return {'VNS': b[1:2].uint, 'VN': b[2:5].uint, 'LTT': b[5:8].uint}
+def mops_ver(data, ofs):
+    b = data[ofs]
+    return {'VNS': (b >> 6) & 0x1, 'VN': (b >> 3) & 0x7, 'LTT': b & 0x7}
 
 
 uap = {
     36: ('ac_op_state', fixed(1), ac_op_state),
-    1: ('data_src', fixed(2), lambda data: {'SAC': data[0], 'SIC': data[1]}),
-    4: ('service_id', fixed(1), lambda data: data[0]),
+    1: ('data_src', fixed(2), lambda data, ofs: {'SAC': data[ofs], 'SIC': data[ofs+1]}),
+    4: ('service_id', fixed(1), lambda data, ofs: data[ofs]),
     35: ('service_mng', fixed(1)),
-    30: ('emitter_cat', fixed(1), lambda data: data[0]),
+    30: ('emitter_cat', fixed(1), lambda data, ofs: data[ofs]),
     2: ('target_report', variable(), target_report),
-    19: ('mode3a_code', fixed(2), lambda data: int.from_bytes(data[:2], byteorder='big', signed=False) & 0xfff),
-    5: ('time_apl_pos', fixed(3), lambda data: extrct(data, 0, 3, signed=False) / 128.0),
-    8: ('time_appl_velo', fixed(3), lambda data: extrct(data, 0, 3, signed=False) / 128.0),
-    12: ('time_recp_pos', fixed(3), lambda data: extrct(data, 0, 3, signed=False) / 128.0),
+    19: ('mode3a_code', fixed(2), lambda data, ofs: uint16(data, ofs) & 0xfff),
+    5: ('time_apl_pos', fixed(3), lambda data, ofs: int24(data, ofs) / 128.0),
+    8: ('time_appl_velo', fixed(3), lambda data, ofs: int24(data, ofs) / 128.0),
+    12: ('time_recp_pos', fixed(3), lambda data, ofs: int24(data, ofs) / 128.0),
     13: ('time_recp_pos_hp', fixed(4), time_recp_pos_hp),
-    14: ('time_recp_velo', fixed(3), lambda data: extrct(data, 0, 3, signed=False) / 128.0),
+    14: ('time_recp_velo', fixed(3), lambda data, ofs: int24(data, ofs) / 128.0),
     15: ('time_recp_velo_hp', fixed(4), time_recp_pos_hp),
-    28: ('time_trans', fixed(3), lambda data: extrct(data, 0, 3, signed=False) / 128.0),
-    11: ('target_adr', fixed(3), lambda data: data[:3].hex()),
+    28: ('time_trans', fixed(3), lambda data, ofs: int24(data, ofs) / 128.0),
+    11: ('target_adr', fixed(3), lambda data, ofs: '%06x' % (data[ofs] << 16 | data[ofs+1] << 8 | data[ofs+2])),
     17: ('quality_ind', variable(), quality_ind),
     34: ('traj_intent', compound({
         1: ('COM', fixed(1)),
         2: ('traj_data', repetive(15))
     })),
-    6: ('pos_wgs84', fixed(6), lambda data: {'lat': round(extrct(data, 0, 3) * (180.0/2**23), 5), 'lon': round(extrct(data, 3, 3) * (180.0/2**23), 5)}),
-    7: ('pos_wgs84', fixed(8), lambda data: {'lat': round(extrct(data, 0, 4) * (180.0/2**30), 5), 'lon': round(extrct(data, 4, 4) * (180.0/2**30), 5)}),
-    38: ('msg_ampl', fixed(1), lambda data: extrct(data, 0, 1)),
-    16: ('geom_height', fixed(2), lambda data: extrct(data, 0, 2, signed=True) * 6.25),
-    21: ('flight_lvl', fixed(2), lambda data: extrct(data, 0, 2, signed=False) / 4.0),
+    6: ('pos_wgs84', fixed(6), lambda data, ofs: {'lat': round(int24(data, ofs) * (180.0/2**23), 5), 'lon': round(int24(data, ofs+3) * (180.0/2**23), 5)}),
+    7: ('pos_wgs84', fixed(8), lambda data, ofs: {'lat': round(extrct(data, ofs, 4) * (180.0/2**30), 5), 'lon': round(extrct(data, ofs+4, 4) * (180.0/2**30), 5)}),
+    38: ('msg_ampl', fixed(1), lambda data, ofs: int8(data, ofs)),
+    16: ('geom_height', fixed(2), lambda data, ofs: int16(data, ofs) * 6.25),
+    21: ('flight_lvl', fixed(2), lambda data, ofs: int16(data, ofs) / 4.0),
     32: ('sel_alt', fixed(2), selected_alt),
     33: ('final_sel_alt', fixed(2)),
     9: ('airspeed', fixed(2)),
@@ -182,7 +264,7 @@ uap = {
     26: ('ground_vector', fixed(4), ground_vector),
     3: ('track_num', fixed(2)),
     27: ('angle_rate', fixed(2)),
-    29: ('target_id', fixed(6), lambda data: decodeIcaoStr(data[:6])),
+    29: ('target_id', fixed(6), lambda data, ofs: decodeIcaoStr(data, ofs)),
     23: ('target_state', fixed(1), target_state),
     18: ('mops_ver', fixed(1), mops_ver),
     31: ('met_info', compound({
@@ -226,16 +308,154 @@ uap = {
 }
 
 
-def decode_records(data):
+plans = {}    # decoding plans by projected field names
+
+
+def get_plan(fields=None):
+    """Return decoding plan for uap, restricted to item names in fields if given"""
+    key = None if fields is None else frozenset(fields)
+    if key not in plans:
+        plans[key] = compile_uap(uap, key)
+    return plans[key]
+
+
+def locate_records(data, ofs=0):
+    """
+    Locate the COLUMN_ITEMS of all records of a block's data section, starting at ofs of data
+    Return list of (record start, record end, {frn: item offset}), offsets into data
+    """
+    plan = get_locator()
+    ret = []
+    end = len(data)
+    while end - ofs > 1:
+        items = {}
+        start = ofs
+        ofs = iterate_fields(plan, data, ofs, items)
+        ret.append((start, ofs, items))
+    return ret
+
+
+def decode_records(data, fields=None, raw=False):
+    """
+    Decode all records of a block's data section (bytes or memoryview)
+    fields: optional iterable of item names to decode, other items are skipped
+    raw: add the undecoded record as bytes under 'raw', to decode it fully later
+    """
+    plan = get_plan(fields)
     ret = []
-    while len(data) > 1:
+    ofs, end = 0, len(data)
+    while end - ofs > 1:
         s = {}
-        rec_size = iterate_fields(uap, data, s)
+        start = ofs
+        ofs = iterate_fields(plan, data, ofs, s)
+        if raw:
+            s['raw'] = bytes(data[start:ofs])
         ret.append(s)
-        data = data[rec_size:]
     return ret
 
 
+def be_uint(a, offsets, size):
+    """Big endian unsigned ints of size bytes at offsets of uint8 array a"""
+    v = np.zeros(len(offsets), dtype=np.int64)
+    for i in range(size):
+        v = v << 8 | a[offsets + i]
+    return v
+
+
+def be_int(a, offsets, size):
+    """Big endian signed ints of size bytes at offsets of uint8 array a"""
+    v = be_uint(a, offsets, size)
+    return v - ((v >> (8*size - 1)) << (8*size))
+
+
+def icao_strs(a, offsets):
+    """decodeIcaoStr() of the 6 bytes at offsets of uint8 array a, as array of 8 byte strings"""
+    chrs = np.frombuffer(ICAO_CHRS.encode('ascii'), dtype=np.uint8)
+    v = be_uint(a, offsets, 6)
+    return chrs[(v[:, None] >> np.arange(42, -1, -6)) & 0x3f].view('S8').ravel()
+
+
+# numpy columns of decode_columns(), has_* are presence masks of the optional items
+COLUMN_DTYPE = [
+    ('block_stamp', 'f8'),
+    ('target_adr', 'u4'),
+    ('lat', 'f8'),
+    ('lon', 'f8'),
+    ('geom_height', 'f8'),
+    ('flight_lvl', 'f8'),
+    ('time_trans', 'f8'),
+    ('mode3a_code', 'u2'),
+    ('emitter_cat', 'u1'),
+    ('target_id', 'S8'),
+    ('has_target_adr', '?'),
+    ('has_pos', '?'),
+    ('has_geom_height', '?'),
+    ('has_flight_lvl', '?'),
+    ('has_time_trans', '?'),
+    ('has_mode3a_code', '?'),
+    ('has_emitter_cat', '?'),
+    ('has_target_id', '?'),
+]
+
+# frn -> (presence column, function of (uint8 array, item offsets) returning {column: values}), as the uap callbacks
+COLUMN_ITEMS = {
+    11: ('has_target_adr', lambda a, o: {'target_adr': be_uint(a, o, 3)}),
+    6: ('has_pos', lambda a, o: {'lat': np.round(be_int(a, o, 3) * (180.0/2**23), 5), 'lon': np.round(be_int(a, o+3, 3) * (180.0/2**23), 5)}),
+    7: ('has_pos', lambda a, o: {'lat': np.round(be_int(a, o, 4) * (180.0/2**30), 5), 'lon': np.round(be_int(a, o+4, 4) * (180.0/2**30), 5)}),
+    16: ('has_geom_height', lambda a, o: {'geom_height': be_int(a, o, 2) * 6.25}),
+    21: ('has_flight_lvl', lambda a, o: {'flight_lvl': be_int(a, o, 2) / 4.0}),
+    28: ('has_time_trans', lambda a, o: {'time_trans': be_int(a, o, 3) / 128.0}),
+    19: ('has_mode3a_code', lambda a, o: {'mode3a_code': be_uint(a, o, 2) & 0xfff}),
+    30: ('has_emitter_cat', lambda a, o: {'emitter_cat': a[o]}),
+    29: ('has_target_id', lambda a, o: {'target_id': icao_strs(a, o)}),
+}
+
+
+def get_locator():
+    """Return plan locating the COLUMN_ITEMS"""
+    if 'locator' not in plans:
+        plans['locator'] = compile_locator(uap, COLUMN_ITEMS)
+    return plans['locator']
+
+
+def decode_columns(data, records, stamps):
+    """
+    Decode the items of records of locate_records() in data (bytes or bytearray) into a numpy
+    structured array of COLUMN_DTYPE, one row per record. stamps: block stamp per record
+    Items are decoded column by column for all records at once.
+    """
+    a = np.frombuffer(data, dtype=np.uint8)
+    cols = np.zeros(len(records), dtype=COLUMN_DTYPE)
+    cols['block_stamp'] = stamps
+    for frn, (has, decode) in COLUMN_ITEMS.items():
+        offsets = np.fromiter((items.get(frn, -1) for _, _, items in records), dtype=np.int64, count=len(records))
+        present = offsets >= 0
+        if not present.any():
+            continue
+        cols[has] |= present
+        for name, values in decode(a, offsets[present]).items():
+            cols[name][present] = values
+    return cols
+
+
+def column_record(row):
+    """Record dict of a row of decode_columns(), with the items decode_records() would give"""
+    rec = {}
+    if row['has_target_adr']:
+        rec['target_adr'] = '%06x' % row['target_adr']
+    if row['has_pos']:
+        rec['pos_wgs84'] = {'lat': float(row['lat']), 'lon': float(row['lon'])}
+    for name in ('geom_height', 'flight_lvl', 'time_trans'):
+        if row['has_' + name]:
+            rec[name] = float(row[name])
+    for name in ('mode3a_code', 'emitter_cat'):
+        if row['has_' + name]:
+            rec[name] = int(row[name])
+    if row['has_target_id']:
+        rec['target_id'] = row['target_id'].decode('ascii')
+    return rec
+
+
 if __name__ == '__main__':
     TESTBLOCK = bytes.fromhex("150048dd1ff34bc1222f28010804439eca23c4ad058b9e4ba74b439eca25\
     1378c3439d6f3787d81b18240f5101b00205f0000785cfb3439ed1407535\
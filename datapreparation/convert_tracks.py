@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+
+from adsbdata import lod, trackfile
+from adsbdata.util import write_atomic
+
+'''
+Convert json track files into the compact binary format, adding levels of detail if missing
+'''
+
+
+def convert(filename, remove=False):
+    """
+    Write <name>.trk.gz for <name>.json, optionally remove the json file
+    Return (json size, binary size)
+    """
+    with open(filename, 'r') as file:
+        track = json.load(file)
+
+    if 'lod' not in track:
+        track['lod'] = lod.lod_levels(track['positions'])
+
+    data = trackfile.encode(track)
+    outname = trackfile.binary_filename(filename)
+    write_atomic(outname, lambda file: file.write(data), binary=True)
+
+    size = os.path.getsize(filename)
+    if remove:
+        os.remove(filename)
+
+    return size, len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert json tracks to binary format')
+    parser.add_argument('filenames', help='filename(s)', nargs='+')
+    parser.add_argument('--remove', dest='remove', action='store_true', help='Remove json files after conversion')
+
+    args = parser.parse_args()
+
+    total_json = total_bin = 0
+    for filename in args.filenames:
+        try:
+            json_size, bin_size = convert(filename, args.remove)
+        except ValueError as e:
+            print('Skipping {}: {}'.format(filename, e))
+            continue
+        total_json += json_size
+        total_bin += bin_size
+
+    print('{} bytes json -> {} bytes binary'.format(total_json, total_bin))
@@ -1,22 +1,107 @@
 import argparse
+from contextlib import contextmanager
 from datetime import datetime
+import fcntl
 import os
-import sys
 import json
 from collections import OrderedDict
 import subprocess as sp
 
+from adsbdata import archiveindex, daybundle, heatmap, trackfile, trafficstats
+from adsbdata.util import write_atomic
+
+MAININDEX = 'mainindex.json'
+MANIFEST = 'mainindex.manifest.json'   # mtime, size and date of indexed track files
+ACSTATS = 'ac_stats.txt'
+LOCKFILE = 'mainindex.lock'     # held while the index files are updated
+
+HEAT_DAYS_KEPT = 2   # days of heatmap bins kept in memory for incremental updates
+
 args = None
-daystats = OrderedDict()
-iacoadrs = {}
+
+
+class JsonFragments:
+    """
+    json text of a dict written again and again, only values of changed keys are serialized again
+    """
+    def __init__(self):
+        self.parts = {}
+
+    def clear(self):
+        self.parts.clear()
+
+    def dumps(self, d, changed):
+        parts = {}
+        for key, value in d.items():
+            part = self.parts.get(key) if key not in changed else None
+            if part is None:
+                part = json.dumps(key) + ':' + json.dumps(value, separators=(',', ':'))
+            parts[key] = part
+        self.parts = parts
+        return '{' + ',\n'.join(parts.values()) + '}'
+
 
 def _datetime_isoformat(dt: datetime):
     return dt.strftime('%Y-%m-%dT%H:%M:%S')
 
 
-def process_track(filename):
-    with open(filename, 'r') as file:
-        track = json.load(file)
+class Index:
+    """
+    Index files of outdir (main index, manifest, aircraft list, traffic stats, heatmap bins, archive index)
+    held in memory. Changes since the last save() are tracked, so only they are serialized again.
+    Writers hold the lock file of outdir, an index changed by another process meanwhile is read again.
+    Track files are expected in outdir, where the web app reads them from.
+    """
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.archive = archiveindex.connect(outdir)
+        self.loaded = False     # index files read or written, kept in memory
+        self.mtimes = None  # mtimes of main index and manifest as last read or written
+        self.daystats = OrderedDict()
+        self.iacoadrs = {}
+        self.manifest = {}
+        self.trafficdays = {}  # date -> traffic summary
+        self.trafficmonths = {}
+        self.trafficyears = {}
+        self.track_paths = {}  # json name -> path of track files read
+
+        # changes since the last save()
+        self.changed_dates = set()   # dates of main index and traffic stats to write
+        self.changed_names = set()   # manifest entries to write
+        self.new_iacoadrs = []   # addresses to append to ACSTATS
+        self.heat_incremental = False    # add pixels of new tracks to the stored bins instead of rebuilding their days
+        self.heat_pending = {}   # date -> {json name: pixel keys} of tracks added
+        self.heat_rebuild = set()    # dates with heatmap bins to rebuild from all their tracks
+        self.heat_days = OrderedDict()   # date -> heatmap bins as last saved
+
+        self.mainindex_json = JsonFragments()
+        self.manifest_json = JsonFragments()
+        self.trafficdays_json = JsonFragments()
+
+    def path(self, name):
+        return os.path.join(self.outdir, name)
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock file of outdir, other writers of the index files wait"""
+        with open(self.path(LOCKFILE), 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            yield   # released with closing
+
+    def file_mtimes(self):
+        mtimes = []
+        for name in (MAININDEX, MANIFEST):
+            try:
+                mtimes.append(os.stat(self.path(name)).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def process_track(self, filename):
+        """
+        Add track file (json or binary) to daystats, return date of track
+        """
+        track = trackfile.read(filename)
 
         start = datetime.utcfromtimestamp(track['start'])
         end = datetime.utcfromtimestamp(track['end'])
@@ -25,28 +110,299 @@ def process_track(filename):
         start_yday = start.timetuple().tm_yday
         end_date = end.strftime('%Y-%m-%d')
 
-        if start_date not in daystats:
-            daystats[start_date] = []
+        name = trackfile.json_filename(os.path.basename(filename))   # tracks are indexed by json name in any format
+        self.track_paths[name] = filename
+        replaced = self.remove_track(start_date, name)   # same track in another format
+        if start_date not in self.daystats:
+            self.daystats[start_date] = []
+
+        entry = {'start': _datetime_isoformat(start), 'end': _datetime_isoformat(end), 'target_adr': track['report']['target_adr'],
+        'target_id': track['target_id'], 'filename': name, 'runway': trafficstats.track_runway(track)}
+        entry.update(trackfile.summary(track))
+        self.daystats[start_date].append(entry)
+
+        if track['report']['target_adr'] not in self.iacoadrs:
+            self.iacoadrs[track['report']['target_adr']] = True
+            self.new_iacoadrs.append(track['report']['target_adr'])
+
+        archiveindex.add_track(self.archive, name, track)
+
+        if self.heat_incremental and heatmap.np is not None:
+            pending = self.heat_pending.setdefault(start_date, {})
+            if replaced and name not in pending:
+                self.heat_rebuild.add(start_date)    # pixels of the former entry are in the stored bins
+            pending[name] = heatmap.track_pixels(track)
+
+        return start_date
+
+    def remove_track(self, date, filename):
+        """Remove index entry of track file, return True if there was one"""
+        entries = [entry for entry in self.daystats.get(date, []) if entry['filename'] != filename]
+        removed = len(entries) < len(self.daystats.get(date, []))
+        if entries:
+            self.daystats[date] = entries
+        else:
+            self.daystats.pop(date, None)
+        return removed
+
+    def update_stats(self, filenames):
+        """
+        Add new or changed track files to daystats, files unchanged since they were indexed are skipped.
+        Return set of changed dates
+        """
+        changed = set()
+        for filename in filenames:
+            st = os.stat(filename)
+            name = os.path.basename(filename)
+            known = self.manifest.get(name)
+            if known is not None:
+                if known['mtime'] == st.st_mtime and known['size'] == st.st_size:
+                    continue
+                if self.remove_track(known['date'], trackfile.json_filename(name)):
+                    self.heat_rebuild.add(known['date'])
+                changed.add(known['date'])
+
+            date = self.process_track(filename)
+            self.manifest[name] = {'mtime': st.st_mtime, 'size': st.st_size, 'date': date}
+            self.changed_names.add(name)
+            changed.add(date)
+
+        self.dates_changed(changed)
+        if not self.heat_incremental:
+            self.heat_rebuild.update(changed)
+
+        return changed
+
+    def dates_changed(self, changed):
+        """Sort entries and update traffic summaries of changed dates"""
+        for date in changed:
+            if date in self.daystats:
+                self.daystats[date].sort(key=lambda entry: (entry['start'], entry['filename']))
+                self.trafficdays[date] = trafficstats.day_summary(self.daystats[date])
+            else:
+                self.trafficdays.pop(date, None)
 
-        daystats[start_date].append({'start': _datetime_isoformat(start), 'end': _datetime_isoformat(end), 'target_adr': track['report']['target_adr'],
-        'target_id': track['target_id'], 'filename': os.path.basename(filename)})
+        if any(a > b for a, b in zip(self.daystats, list(self.daystats)[1:])):
+            for date in sorted(self.daystats):
+                self.daystats.move_to_end(date)
 
-        iacoadrs[track['report']['target_adr']] = True
+        self.changed_dates.update(changed)
 
+    def stored(self, name, date):
+        """True if track of json name is in outdir in any format or in the day bundle of date"""
+        if os.path.exists(self.path(name)) or os.path.exists(self.path(trackfile.binary_filename(name))):
+            return True
+        bundle = self.open_bundle(date)
+        return bundle is not None and name in bundle
 
-def print_stats():
-    _ = sp.call('clear', shell=True)  # clear the terminal
-    for date, entries in daystats.items():
-        print(date, len(entries), entries)
+    def prune(self):
+        """
+        Drop manifest entries whose track file disappeared from outdir, tracks not stored
+        in another format or in the day bundle are removed from the index.
+        Return set of changed dates
+        """
+        changed = set()
+        for name in [name for name in self.manifest if not os.path.exists(self.path(name))]:
+            date = self.manifest.pop(name)['date']
+            json_name = trackfile.json_filename(name)
+            if not self.stored(json_name, date) and self.remove_track(date, json_name):
+                archiveindex.remove_track(self.archive, json_name)
+                changed.add(date)
 
+        self.dates_changed(changed)
+        self.heat_rebuild.update(changed)
+        return changed
 
-def save_stats():
-    with open(args.outdir + 'mainindex.json', 'w') as file:
-        json.dump(daystats, file, indent=1)
+    def load(self):
+        """Read existing index, aircraft list and manifest of outdir"""
+        self.daystats.clear()
+        self.iacoadrs.clear()
+        self.manifest.clear()
+        self.trafficdays.clear()
+        self.trafficmonths.clear()
+        self.trafficyears.clear()
+        self.track_paths.clear()
+        self.heat_days.clear()
+        for fragments in (self.mainindex_json, self.manifest_json, self.trafficdays_json):
+            fragments.clear()
+        self.loaded = True
+        self.mtimes = self.file_mtimes()
+        if os.path.exists(self.path(MAININDEX)):
+            with open(self.path(MAININDEX), 'r') as file:
+                self.daystats.update(json.load(file, object_pairs_hook=OrderedDict))
 
-    with open(args.outdir + 'ac_stats.txt', 'w') as file:
-        for line in iacoadrs.keys():
-            file.write(line + '\n')
+        if os.path.exists(self.path(ACSTATS)):
+            with open(self.path(ACSTATS), 'r') as file:
+                self.iacoadrs.update((line.strip(), True) for line in file if line.strip())
+
+        if os.path.exists(self.path(MANIFEST)):
+            with open(self.path(MANIFEST), 'r') as file:
+                self.manifest.update(json.load(file))
+
+        if os.path.exists(self.path(trafficstats.TRAFFICSTATS)):
+            with open(self.path(trafficstats.TRAFFICSTATS), 'r') as file:
+                stats = json.load(file)
+            self.trafficdays.update(stats['days'])
+            self.trafficmonths.update(stats['months'])
+            self.trafficyears.update(stats['years'])
+
+    def load_incremental(self):
+        """
+        Read existing index files and bring them up to date with outdir: tracks whose files
+        disappeared are dropped, traffic summaries of days indexed without them are added.
+        Return set of changed dates
+        """
+        self.load()
+        return self.prune() | self.backfill_traffic()
+
+    def backfill_traffic(self):
+        """
+        Add traffic summaries of days indexed without them, tracks of entries lacking
+        the classification are read once to add it.
+        Return set of backfilled dates
+        """
+        backfilled = set()
+        for date, entries in self.daystats.items():
+            if date in self.trafficdays:
+                continue
+            bundle = self.open_bundle(date) if any('runway' not in entry for entry in entries) else None
+            for entry in entries:
+                if 'runway' not in entry:
+                    track = self.read_indexed_track(entry['filename'], bundle)
+                    if track is not None:
+                        entry['emittercat'] = track.get('emittercat')
+                        entry['runway'] = trafficstats.track_runway(track)
+            self.trafficdays[date] = trafficstats.day_summary(entries)
+            backfilled.add(date)
+
+        self.changed_dates.update(backfilled)
+        return backfilled
+
+    def update_index(self, filenames):
+        """
+        Merge new or changed track files into the index files of outdir.
+        The index is kept in memory between calls and read again when another process changed it.
+        Heatmap bins of new tracks are added to those of their day, only days with changed
+        or removed tracks are rebuilt.
+        Return set of changed dates
+        """
+        with self.locked():
+            self.heat_incremental = True
+            changed = set()
+            if not self.loaded or self.file_mtimes() != self.mtimes:
+                changed = self.load_incremental()
+            changed |= self.update_stats(filenames)
+            if changed:
+                self.save()
+        return changed
+
+    def print_stats(self):
+        _ = sp.call('clear', shell=True)  # clear the terminal
+        for date, entries in self.daystats.items():
+            print(date, len(entries), entries)
+
+    def read_indexed_track(self, name, bundle=None):
+        """
+        Read track of index entry from the file read before, from outdir or from the day bundle,
+        None if there is none
+        """
+        paths = [self.track_paths[name]] if name in self.track_paths else []
+        paths += [self.path(trackfile.binary_filename(name)), self.path(name)]
+        for path in paths:
+            if os.path.exists(path):
+                return trackfile.read(path)
+
+        stored = bundle.get(name) if bundle is not None else None
+        if stored is None:
+            return None
+        data, fmt = stored
+        return trackfile.decode(data) if fmt == 'trk' else json.loads(data)
+
+    def open_bundle(self, date):
+        """Return day bundle of date in outdir, None if there is none"""
+        filename = self.path(daybundle.bundle_filename(date))
+        return daybundle.DayBundle(filename) if os.path.exists(filename) else None
+
+    def keep_heat_day(self, date, bins):
+        self.heat_days.pop(date, None)
+        self.heat_days[date] = bins
+        while len(self.heat_days) > HEAT_DAYS_KEPT:
+            self.heat_days.popitem(last=False)
+
+    def save_heatmap(self):
+        """Rebuild heatmap bins of dates to rebuild, add pixels of new tracks to the bins of other dates"""
+        if heatmap.np is None:
+            self.heat_rebuild.clear()
+            self.heat_pending.clear()
+            return
+
+        for date in self.heat_rebuild:
+            self.heat_days.pop(date, None)
+            if date not in self.daystats:
+                heatmap.remove_day(self.outdir, date)
+                continue
+
+            bundle = self.open_bundle(date)
+            tracks = [self.read_indexed_track(entry['filename'], bundle) for entry in self.daystats[date]]
+            missing = tracks.count(None)
+            if missing:     # bins of a part of the day would replace those of the whole day
+                print('Heatmap of {} not updated, {} track files missing'.format(date, missing))
+                continue
+            bins = heatmap.day_bins(tracks)
+            heatmap.save_day(self.outdir, date, bins)
+            self.keep_heat_day(date, bins)
+
+        for date, pending in self.heat_pending.items():
+            if date in self.heat_rebuild:
+                continue
+            bins = self.heat_days.get(date) or heatmap.load_day(self.outdir, date)
+            bins = heatmap.add_pixels(bins, list(pending.values()))
+            heatmap.save_day(self.outdir, date, bins)
+            self.keep_heat_day(date, bins)
+
+        self.heat_rebuild.clear()
+        self.heat_pending.clear()
+
+    def update_rollups(self):
+        """Recompute monthly and yearly traffic rollups of changed dates"""
+        for rollups, length in ((self.trafficmonths, 7), (self.trafficyears, 4)):
+            for period in {date[:length] for date in self.changed_dates}:
+                days = {date: day for date, day in self.trafficdays.items() if date.startswith(period)}
+                if days:
+                    rollups[period] = trafficstats.rollup(days)
+                else:
+                    rollups.pop(period, None)
+
+    def save(self):
+        """
+        Write index files of outdir, values of unchanged days and manifest entries are reused as serialized before,
+        new aircraft addresses are appended
+        """
+        self.archive.commit()
+
+        write_atomic(self.path(MAININDEX), lambda file: file.write(self.mainindex_json.dumps(self.daystats, self.changed_dates)))
+
+        if self.loaded and os.path.exists(self.path(ACSTATS)):
+            with open(self.path(ACSTATS), 'a') as file:
+                file.writelines(adr + '\n' for adr in self.new_iacoadrs)
+        else:
+            write_atomic(self.path(ACSTATS), lambda file: file.writelines(adr + '\n' for adr in self.iacoadrs.keys()))
+        self.new_iacoadrs.clear()
+
+        write_atomic(self.path(MANIFEST), lambda file: file.write(self.manifest_json.dumps(self.manifest, self.changed_names)))
+
+        self.update_rollups()
+        days = dict(sorted(self.trafficdays.items()))
+        write_atomic(self.path(trafficstats.TRAFFICSTATS), lambda file: file.write('{"days":' + self.trafficdays_json.dumps(days, self.changed_dates)
+            + ',"months":' + json.dumps(dict(sorted(self.trafficmonths.items())), separators=(',', ':'))
+            + ',"years":' + json.dumps(dict(sorted(self.trafficyears.items())), separators=(',', ':')) + '}'))
+
+        self.save_heatmap()
+        self.changed_dates.clear()
+        self.changed_names.clear()
+        self.track_paths.clear()
+        self.loaded = True
+        self.mtimes = self.file_mtimes()
 
 
 if __name__ == '__main__':
@@ -58,11 +414,18 @@ if __name__ == '__main__':
     parser.add_argument('--timeout', dest='track_timeout', type=float, help='Track timeout (s)', default=60.0)
     parser.add_argument('--reports', dest='track_min', type=float, help='Min reports for track', default=3)
     parser.add_argument('--outdir', dest='outdir', help='Output directory', default='./')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='Merge new or changed files into existing index')
 
     args = parser.parse_args()
 
-    for filename in args.filenames:
-        process_track(filename)
-        #print_stats()
+    index = Index(args.outdir)
+    with index.locked():
+        if args.incremental:
+            index.load_incremental()
+        else:
+            archiveindex.clear(index.archive)
+
+        index.update_stats(args.filenames)
+        #index.print_stats()
 
-    save_stats()
+        index.save()
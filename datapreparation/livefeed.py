@@ -0,0 +1,98 @@
+import socket
+import time
+
+'''
+Live Asterix input from UDP datagrams or a TCP stream
+'''
+
+IDLE_INTERVAL = 1.0   # (s) without data after which an idle tick is yielded
+RECV_SIZE = 65536
+
+
+def complete_blocks(buf):
+    """
+    Return (length of the leading complete asterix blocks in buf, True if they are followed by an invalid block size)
+    """
+    ofs, end = 0, len(buf)
+    while end - ofs >= 3:
+        blocksize = buf[ofs+1] << 8 | buf[ofs+2]
+        if blocksize < 3:
+            return ofs, True
+        if end - ofs < blocksize:
+            break
+        ofs += blocksize
+    return ofs, False
+
+
+def resync(buf):
+    """
+    Find the first cat21 block in buf with a valid size, confirmed by another cat21 block following it
+    Return (offset, True) if found, else (offset to search again from with more data, False)
+    """
+    ofs = buf.find(b'\x15')
+    while ofs >= 0:
+        if len(buf) - ofs < 3:
+            return ofs, False
+        blocksize = buf[ofs+1] << 8 | buf[ofs+2]
+        if blocksize >= 3:
+            if len(buf) - ofs <= blocksize:
+                return ofs, False
+            if buf[ofs+blocksize] == 21:
+                return ofs, True
+        ofs = buf.find(b'\x15', ofs + 1)
+    return len(buf), False
+
+
+def udp_blocks(host, port):
+    """
+    Receive asterix blocks on UDP socket
+    Yields (stamp, data) per datagram, (stamp, None) when idle
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((host, port))
+        sock.settimeout(IDLE_INTERVAL)
+        while True:
+            try:
+                data = sock.recv(RECV_SIZE)
+            except socket.timeout:
+                yield time.time(), None
+                continue
+            yield time.time(), data
+
+
+def tcp_blocks(host, port, log=print):
+    """
+    Read asterix blocks from a TCP stream
+    Yields (stamp, data) with complete blocks, (stamp, None) when idle. Ends when the peer closes.
+    After an invalid block size the stream is resynced at the next cat21 block found, reported to log.
+    """
+    with socket.create_connection((host, port)) as sock:
+        sock.settimeout(IDLE_INTERVAL)
+        buf = bytearray()
+        skipped = None  # bytes dropped while resyncing
+        while True:
+            try:
+                chunk = sock.recv(RECV_SIZE)
+            except socket.timeout:
+                yield time.time(), None
+                continue
+            if not chunk:
+                break
+            buf += chunk
+            while True:
+                if skipped is not None:
+                    ofs, found = resync(buf)
+                    skipped += ofs
+                    del buf[:ofs]
+                    if not found:
+                        break
+                    log('Invalid asterix block size, skipped {} bytes'.format(skipped))
+                    skipped = None
+
+                n, invalid = complete_blocks(buf)
+                if n > 0:
+                    yield time.time(), buf[:n]
+                    del buf[:n]
+                if not invalid:
+                    break
+                skipped = 0
@@ -0,0 +1,67 @@
+import argparse
+import socket
+import time
+
+from adsbdata.util import parse_address
+from . import asterixfile
+
+'''
+Replay asterixRecorder file as live feed over UDP or TCP
+For testing and load benchmarking of live ingest
+'''
+
+
+def paced(blocks, speed):
+    """Delay (stamp, data) blocks according to their stamps, speed times faster. speed 0: no delay"""
+    start = None
+    for stamp, data in blocks:
+        if speed > 0:
+            if start is None:
+                start = time.monotonic(), stamp
+            delay = start[0] + (stamp - start[1]) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield stamp, data
+
+
+def send_udp(blocks, host, port):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, data in blocks:
+            sock.sendto(data, (host, port))
+            yield len(data)
+
+
+def send_tcp(blocks, host, port):
+    with socket.create_server((host, port)) as server:
+        conn, _ = server.accept()
+        with conn:
+            for _, data in blocks:
+                conn.sendall(data)
+                yield len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay cat21 asterix recording as live feed.')
+    parser.add_argument('filenames', help='filename(s)', nargs='+')
+    parser.add_argument('--udp', dest='udp', help='Send to UDP [host:]port')
+    parser.add_argument('--tcp', dest='tcp', help='Serve on TCP [host:]port, waits for one client')
+    parser.add_argument('--speed', dest='speed', type=float, help='Replay speed factor, 0 for as fast as possible', default=1.0)
+
+    args = parser.parse_args()
+    if not (args.udp or args.tcp):
+        parser.error('--udp or --tcp required')
+
+    blocks = paced((b for filename in args.filenames for b in asterixfile.blocks_from_file(filename)), args.speed)
+    if args.udp:
+        sent = send_udp(blocks, *parse_address(args.udp, 'localhost'))
+    else:
+        sent = send_tcp(blocks, *parse_address(args.tcp, 'localhost'))
+
+    start = time.monotonic()
+    count = size = 0
+    for n in sent:
+        count += 1
+        size += n
+
+    elapsed = time.monotonic() - start
+    print('{} blocks, {} bytes in {:.1f}s ({:.0f} blocks/s)'.format(count, size, elapsed, count / elapsed if elapsed > 0 else 0))
@@ -1,20 +1,38 @@
 import argparse
 from datetime import datetime
-import sys
-from math import radians, cos, sin, asin, sqrt
+from math import radians, degrees, cos, sin, asin, sqrt, nan, isnan
+from array import array
+from functools import lru_cache
+from itertools import islice
 from dataclasses import dataclass, field, asdict
-import subprocess as sp
+import time
+from collections import deque
 import json
+import heapq
+import multiprocessing
+from operator import itemgetter
 
 
-import asterixfile
+from adsbdata import livestream, lod, trackfile
+from adsbdata.util import EDTF, parse_address
+from . import asterixfile, cat21, genstats, livefeed
+try:
+    import numpy as np   # columnar decoding and filtering, records are decoded and checked one by one without it
+except ImportError:
+    np = None
 
 
-EDTF = 48.02220, 7.83292
+# cat21 items used by the tracker, everything else is skipped when decoding.
+# Records keep their raw bytes, the first record of a track is saved fully decoded (see full_report())
+TRACK_FIELDS = ('target_adr', 'pos_wgs84', 'geom_height', 'flight_lvl', 'time_trans', 'target_id', 'mode3a_code', 'emitter_cat')
+FILTER_BATCH = 1024  # records per batch without numpy
 
 
 args = None
-msgs = []
+msgs = deque(maxlen=30)
+saved = []  # track files not yet in the main index
+publisher = None    # livestream.Publisher with --live
+stats_index = None  # genstats.Index of outdir with --index
 
 
 def haversine(lat1, lon1, lat2, lon2):
@@ -31,9 +49,42 @@ def haversine(lat1, lon1, lat2, lon2):
     return R * c
 
 
-def record_filter(rec, max_height_ft, max_range_km):
+def haversine_np(lat1, lon1, lat2, lon2):
+    """haversine() over numpy arrays"""
+    R =  6372.8 # Earth radius
+
+    dLat = np.radians(lat2 - lat1)
+    dLon = np.radians(lon2 - lon1)
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+
+    a = np.sin(dLat/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dLon/2)**2
+    c = 2*np.arcsin(np.sqrt(a))
+
+    return R * c
+
+
+@lru_cache()
+def range_box(max_range_km):
     """
-    Return True if record is accepted
+    Bounding box (max lat difference, max lon difference) in degrees around EDTF,
+    outside of which every point is further away than max_range_km.
+    Slightly enlarged to stay clear of rounding issues.
+    """
+    R =  6372.8 # Earth radius
+    c = max_range_km / R
+    max_lat = abs(EDTF[0]) + degrees(c)
+    if max_lat >= 90.0:
+        return 180.0, 360.0
+    # distance at a lon difference is shortest at the highest latitude of the band
+    s = sin(c/2) / cos(radians(max_lat))
+    dlon = degrees(2*asin(s)) if s < 1.0 else 360.0
+    return degrees(c) * 1.001 + 1e-9, dlon * 1.001 + 1e-9
+
+
+def record_prefilter(rec, max_height_ft, max_range_km):
+    """
+    Return True if record passes all checks of record_filter() but the exact range check
     """
     if 'target_adr' not in rec or 'pos_wgs84' not in rec:
         return False
@@ -47,43 +98,206 @@ def record_filter(rec, max_height_ft, max_range_km):
     if 'flight_lvl' in rec and rec['flight_lvl'] * 100 > max_height_ft:
         return False
 
+    dlat, dlon = range_box(max_range_km)
+    pos = rec['pos_wgs84']
+    if abs(pos['lat'] - EDTF[0]) > dlat or abs(pos['lon'] - EDTF[1]) > dlon:
+        return False
+
+    return True
+
+
+def record_filter(rec, max_height_ft, max_range_km):
+    """
+    Return True if record is accepted
+    """
+    if not record_prefilter(rec, max_height_ft, max_range_km):
+        return False
+
     if haversine(*EDTF, rec['pos_wgs84']['lat'], rec['pos_wgs84']['lon']) > max_range_km:
         return False
 
     return True
 
 
+def record_filter_columns(cols, max_height_ft, max_range_km):
+    """
+    record_filter() over numpy columns of asterixfile.columns_from_blocks()
+    Return boolean mask of accepted records
+    """
+    accept = cols['has_target_adr'] & cols['has_pos']
+    accept &= cols['target_adr'] != 0xbaaeb0  # reference transmitter
+    accept &= ~(cols['has_geom_height'] & (cols['geom_height'] > max_height_ft))
+    accept &= ~(cols['has_flight_lvl'] & (cols['flight_lvl'] * 100 > max_height_ft))
+    dlat, dlon = range_box(max_range_km)
+    accept &= (np.abs(cols['lat'] - EDTF[0]) <= dlat) & (np.abs(cols['lon'] - EDTF[1]) <= dlon)
+    ix = np.flatnonzero(accept)
+    accept[ix] = haversine_np(*EDTF, cols['lat'][ix], cols['lon'][ix]) <= max_range_km
+    return accept
+
+
+class Positions:
+    """
+    Thinned position reports of a track in compact arrays.
+    Missing heights are stored as nan.
+    """
+    __slots__ = ('lat', 'lon', 'time_trans', 'geom_height', 'flight_lvl')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, array('d'))
+
+    def __len__(self):
+        return len(self.lat)
+
+    def append(self, report):
+        self.lat.append(report['pos_wgs84']['lat'])
+        self.lon.append(report['pos_wgs84']['lon'])
+        self.time_trans.append(report['time_trans'])
+        self.geom_height.append(report.get('geom_height', nan))
+        self.flight_lvl.append(report.get('flight_lvl', nan))
+
+    def entries(self):
+        """Yield position reports as dicts"""
+        for lat, lon, time_trans, geom_height, flight_lvl in zip(self.lat, self.lon, self.time_trans, self.geom_height, self.flight_lvl):
+            entry = {'lat': lat, 'lon': lon, 'time_trans': time_trans}
+            if not isnan(geom_height):
+                entry['geom_height'] = geom_height
+            if not isnan(flight_lvl):
+                entry['flight_lvl'] = flight_lvl
+            yield entry
+
+
 @dataclass
 class Track:
     adr: str  # icao 24bit adr
     first_report: float
     last_report: float  # timestamp of last report
-    reports: list
+    first: dict = None  # first record, saved as is
+    last: dict = None  # latest record
+    tail: list = field(default_factory=list)  # latest records, not yet thinned
+    positions: Positions = field(default_factory=Positions)
+    num_reports: int = 0
+    last_time_trans: float = None  # time_trans of last kept report
     target_ids: set = field(default_factory=set)
     mode3as: set = field(default_factory=set)
     emittercat: int = None
 
+    def add_report(self, rec):
+        """
+        Add record to track.
+        Reports closer than 1s to the previous kept one are dropped right away,
+        except for the first and the last two, which save_track() treats separately.
+        """
+        if self.first is None:
+            self.first = rec
+            self.last_time_trans = rec['time_trans']
+        else:
+            self.tail.append(rec)
+            if len(self.tail) > 2:
+                report = self.tail.pop(0)
+                if report['time_trans'] > self.last_time_trans + 1.0:
+                    self.positions.append(report)
+                    self.last_time_trans = report['time_trans']
+
+        self.last = rec
+        self.num_reports += 1
+
     def __str__(track):
         return "{}\t{}\t\t{}\t{}–{}\t{}".format(track.adr, track.target_ids, track.mode3as,
-        datetime.utcfromtimestamp(track.first_report), datetime.utcfromtimestamp(track.last_report), len(track.reports))
+        datetime.utcfromtimestamp(track.first_report), datetime.utcfromtimestamp(track.last_report), track.num_reports)
 
 
 tracks = {}
+expiry = []  # heap of (last_report, adr) per active track, last_report may be outdated
 last_stamp = 0
+next_stats = 0  # monotonic time of next terminal update
 
-def tracker(filename, max_height, max_range):
-    global last_stamp
-    for rec in asterixfile.process_file(filename):
-        stamp = rec['block_stamp']
+def record_batches(filename, max_height, max_range):
+    """
+    Yield (block stamps, records) of a recording file in batches, records None where rejected.
+    With numpy the records are decoded into columns and filtered vectorised,
+    only the accepted ones become dicts.
+    """
+    if np is None:
+        records = asterixfile.process_file(filename, TRACK_FIELDS, raw=True)
+        while True:
+            recs = list(islice(records, FILTER_BATCH))
+            if len(recs) == 0:
+                break
+            yield [rec['block_stamp'] for rec in recs], [rec if record_filter(rec, max_height, max_range) else None for rec in recs]
+        return
+
+    for cols, located, data in asterixfile.columns_from_blocks(asterixfile.blocks_from_file(filename)):
+        stamps = cols['block_stamp'].tolist()
+        recs = [None] * len(stamps)
+        for i in np.flatnonzero(record_filter_columns(cols, max_height, max_range)).tolist():
+            rec = cat21.column_record(cols[i])
+            rec['raw'] = bytes(data[located[i][0]:located[i][1]])
+            rec['block_stamp'] = stamps[i]
+            recs[i] = rec
+        yield stamps, recs
+
+
+def filtered_records(filename, max_height, max_range):
+    """
+    Yield (stamp, rec) for accepted records of a recording file.
+    Rejected records are only passed on as (stamp, None) where a 10 second tick
+    falls between them, so a reduced stream drives update_state() like the full one.
+    """
+    last = None  # (stamp, passed on) of previous record
+    for stamps, recs in record_batches(filename, max_height, max_range):
+        for stamp, rec in zip(stamps, recs):
+            tick = last is None or int(last[0]/10.0) != int(stamp/10.0)
+            if tick and last is not None and not last[1]:
+                yield last[0], None
+
+            if rec is not None:
+                yield stamp, rec
+                last = stamp, True
+            elif tick:
+                yield stamp, None
+                last = stamp, True
+            else:
+                last = stamp, False
+
+    if last is not None and not last[1]:
+        yield last[0], None  # end of file may be followed by a tick in the next file
 
-        if record_filter(rec, max_height, max_range):
+
+def live_records(blocks, max_height, max_range):
+    """
+    Yield (stamp, rec) for records of live (stamp, data) blocks.
+    Rejected records and idle ticks without data are passed on as (stamp, None).
+    """
+    for stamp, data in blocks:
+        if data is None:
+            yield stamp, None
+            continue
+        for rec_list in asterixfile.records_from_blocks(data, TRACK_FIELDS, raw=True):
+            for rec in rec_list:
+                rec['block_stamp'] = stamp
+                yield stamp, rec if record_filter(rec, max_height, max_range) else None
+
+
+def filter_file(job):
+    """Process pool worker, return filtered records of a file as list"""
+    filename, max_height, max_range = job
+    return list(filtered_records(filename, max_height, max_range))
+
+
+def replay(records):
+    """Feed (stamp, rec) stream into the track state machine"""
+    global last_stamp
+    for stamp, rec in records:
+        if rec is not None:
 
             if rec['target_adr'] not in tracks:
-                tracks[rec['target_adr']] = Track(rec['target_adr'], stamp, None, [])
+                tracks[rec['target_adr']] = Track(rec['target_adr'], stamp, None)
+                heapq.heappush(expiry, (stamp, rec['target_adr']))
 
             track = tracks[rec['target_adr']]
 
-            track.reports.append(rec)
+            track.add_report(rec)
             if 'target_id' in rec:
                 track.target_ids.add(rec['target_id'])
             if 'mode3a_code' in rec:
@@ -91,84 +305,160 @@ def tracker(filename, max_height, max_range):
             if 'emitter_cat' in rec:
                 track.emittercat = rec['emitter_cat']
             track.last_report = stamp
+            if publisher is not None:
+                publisher.update(rec['target_adr'], rec)
 
         if int(last_stamp/10.0) != int(stamp/10.0):  # every 10 seconds
             update_state()
 
+        if publisher is not None:
+            publisher.flush(stamp)
+
         last_stamp = stamp
 
 
+def tracker(filename, max_height, max_range):
+    replay(filtered_records(filename, max_height, max_range))
+
+
+def tracker_live(blocks, max_height, max_range):
+    replay(live_records(blocks, max_height, max_range))
+
+
+def tracker_parallel(filenames, max_height, max_range, jobs):
+    """
+    Decode and filter files in a process pool, replay them merged in timestamp order.
+    Files are expected in chronological order, streams are merged as long as they overlap
+    in time so that tracks continue across file boundaries.
+    At most jobs files are decoded ahead of the replay, finished files don't pile up in memory.
+    """
+    pending = []  # streams possibly overlapping in time
+    files = iter(filenames)
+    with multiprocessing.Pool(jobs) as pool:
+        window = deque(pool.apply_async(filter_file, ((filename, max_height, max_range),)) for filename in islice(files, jobs))
+        while window:
+            records = window.popleft().get()
+            for filename in islice(files, 1):
+                window.append(pool.apply_async(filter_file, ((filename, max_height, max_range),)))
+            if len(records) == 0:
+                continue
+            if pending and records[0][0] >= max(r[-1][0] for r in pending):
+                replay(heapq.merge(*pending, key=itemgetter(0)))
+                pending = []    # merged files are released
+            pending.append(records)
+
+    replay(heapq.merge(*pending, key=itemgetter(0)))
+
+
 def update_state():
-    for track_adr in list(tracks):
+    """
+    Save or drop timed out tracks.
+    Tracks are taken from the expiry heap in order of their last report,
+    entries whose track got reports since are pushed again with the current time.
+    """
+    while expiry and expiry[0][0] < last_stamp - args.track_timeout:
+        _, track_adr = heapq.heappop(expiry)
         track = tracks[track_adr]
         if track.last_report < last_stamp - args.track_timeout:
-            if len(track.reports) < args.track_min:
+            if track.num_reports < args.track_min:
                 msgs.append("Dropping: " + str(track))
             else:
                 save_track(track)
                 msgs.append("Saving: " + str(track))
             del tracks[track_adr]
+            if publisher is not None:
+                publisher.remove(track_adr)
+        else:
+            heapq.heappush(expiry, (track.last_report, track_adr))
 
-    print_stats()
+    if args.index and saved:
+        stats_index.update_index(saved)
+        saved.clear()
+
+    if args.stats_interval > 0:
+        print_stats()
+
+
+def full_report(rec):
+    """Record decoded with TRACK_FIELDS with all items decoded, as saved in track files"""
+    if 'raw' not in rec:
+        return rec
+    report = cat21.decode_records(rec['raw'])[0]
+    report['block_stamp'] = rec['block_stamp']
+    return report
 
 
 def save_track(track):
     filename = datetime.utcfromtimestamp(track.first_report).strftime('%Y-%m-%d_%H:%M:%S') + '_' + str(track.adr) + '.json'
 
-    # consolidate reports
-    # skip reports which are too close to another to save space
-    position_reports = []
-    last_time_trans = track.reports[0]['time_trans']
-    position_reports.append(track.reports[0]['pos_wgs84'])  # add the first
-    for i in range(1, len(track.reports) - 2):
-        report = track.reports[i]
-        if report['time_trans'] > last_time_trans + 1.0:
-            entry = {}
-            entry.update(report['pos_wgs84'])
-            entry['time_trans'] = report['time_trans']
-            if 'geom_height' in report:
-                entry['geom_height'] = report['geom_height']
-            if 'flight_lvl' in report:
-                entry['flight_lvl'] = report['flight_lvl']
-            position_reports.append(entry)
-            last_time_trans = report['time_trans']
-        else:
-            continue  # skip this report
-
-    position_reports.append(track.reports[-1]['pos_wgs84'])  # add the last
+    # reports too close to another are already skipped to save space
+    position_reports = [track.first['pos_wgs84']]  # add the first
+    position_reports.extend(track.positions.entries())
+    position_reports.append(track.last['pos_wgs84'])  # add the last
 
     target_id = next(iter(track.target_ids)) if len(track.target_ids) > 0 else None
     mode3a = next(iter(track.mode3as)) if len(track.mode3as) > 0 else None
 
-    with open(args.outdir + '/' + filename, 'w') as file:
-        json.dump({'start': track.first_report, 'end': track.last_report, 'report': track.reports[0],
-        'target_id': target_id, 'mode3a': mode3a, 'emittercat': track.emittercat, 'positions': position_reports}, file)
+    data = {'start': track.first_report, 'end': track.last_report, 'report': full_report(track.first),
+        'target_id': target_id, 'mode3a': mode3a, 'emittercat': track.emittercat, 'positions': position_reports,
+        'lod': lod.lod_levels(position_reports)}
 
+    if args.format in ('json', 'both'):
+        with open(args.outdir + '/' + filename, 'w') as file:
+            json.dump(data, file)
+        saved.append(args.outdir + '/' + filename)
+
+    if args.format in ('trk', 'both'):
+        with open(args.outdir + '/' + trackfile.binary_filename(filename), 'wb') as file:
+            file.write(trackfile.encode(data))
+        saved.append(args.outdir + '/' + trackfile.binary_filename(filename))
 
-def print_stats():
-    global msgs
-    _ = sp.call('clear', shell=True)  # clear the terminal
-    print(datetime.utcfromtimestamp(last_stamp), end='\n')
-    for track in tracks.values():
-        print(track)
 
-    if len(msgs) > 30:
-        msgs = msgs[-30:]
+def print_stats():
+    """Redraw terminal, at most every args.stats_interval seconds"""
+    global next_stats
+    now = time.monotonic()
+    if now < next_stats:
+        return
+    next_stats = now + args.stats_interval
 
-    for msg in msgs[::-1]:
-        print(msg)
+    lines = [str(datetime.utcfromtimestamp(last_stamp))]
+    lines.extend(str(track) for track in tracks.values())
+    lines.extend(reversed(msgs))
+    print('\033[H\033[2J' + '\n'.join(lines), flush=True)  # clear the terminal
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate tracks from Cat21.')
-    parser.add_argument('filenames', help='filename(s)', nargs='+')
+    parser.add_argument('filenames', help='filename(s)', nargs='*')
     parser.add_argument('--height', dest='max_height', type=float, help='Max height (ft)', default=5000.0)
     parser.add_argument('--range', dest='max_range', type=float, help='Max dist from EDTF (km)', default=30.0)
     parser.add_argument('--timeout', dest='track_timeout', type=float, help='Track timeout (s)', default=60.0)
     parser.add_argument('--reports', dest='track_min', type=float, help='Min reports for track', default=5)
     parser.add_argument('--outdir', dest='outdir', help='Output directory', default='./')
+    parser.add_argument('--jobs', dest='jobs', type=int, help='Decode files in N processes', default=1)
+    parser.add_argument('--udp', dest='udp', help='Live input from UDP [host:]port')
+    parser.add_argument('--tcp', dest='tcp', help='Live input from TCP [host:]port')
+    parser.add_argument('--format', dest='format', choices=('json', 'trk', 'both'), help='Track file format', default='json')
+    parser.add_argument('--index', dest='index', action='store_true', help='Add saved tracks to main and archive index of outdir')
+    parser.add_argument('--live', dest='live', help='Publish live positions to the web app at UDP [host:]port')
+    parser.add_argument('--stats-interval', dest='stats_interval', type=float, help='Terminal update interval (s), 0 for none', default=1.0)
 
     args = parser.parse_args()
-
-    for filename in args.filenames:
-        tracker(filename, args.max_height, args.max_range)
+    if not (args.filenames or args.udp or args.tcp):
+        parser.error('filename(s), --udp or --tcp required')
+
+    if args.live:
+        publisher = livestream.Publisher(parse_address(args.live, '127.0.0.1'))
+    if args.index:
+        stats_index = genstats.Index(args.outdir)
+
+    if args.udp:
+        tracker_live(livefeed.udp_blocks(*parse_address(args.udp)), args.max_height, args.max_range)
+    elif args.tcp:
+        tracker_live(livefeed.tcp_blocks(*parse_address(args.tcp, 'localhost'), log=msgs.append), args.max_height, args.max_range)
+    elif args.jobs > 1:
+        tracker_parallel(args.filenames, args.max_height, args.max_range, args.jobs)
+    else:
+        for filename in args.filenames:
+            tracker(filename, args.max_height, args.max_range)